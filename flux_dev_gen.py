@@ -31,12 +31,15 @@ image = (
         "HF_HUB_ENABLE_HF_TRANSFER": "1",
         "HF_HOME": CACHE_DIR,
     })
+    .add_local_file("image_encoding.py", "/root/image_encoding.py")
 )
 
 with image.imports():
     import torch
     from diffusers import FluxPipeline
 
+    from image_encoding import ImageEncoder, check_output_format, encode_image
+
 
 @app.cls(
     gpu="A100-80GB",
@@ -61,6 +64,57 @@ class ImageGenerator:
         )
         self.pipe.to("cuda")
 
+        # Images are encoded off the GPU thread
+        self.encoder = ImageEncoder()
+        # Images per pipeline call in generate_batch
+        self.max_batch_size = 4
+
+    def _generate(
+        self,
+        prompts: list[str],
+        height: int,
+        width: int,
+        guidance_scale: float,
+        num_inference_steps: int,
+        seeds: list[int | None],
+        num_images_per_prompt: int,
+        output_format: str,
+        quality: int,
+        compress_level: int,
+    ) -> list:
+        check_output_format(output_format)
+
+        # One generator per image, so image j of prompt i matches a single
+        # generation with seed seeds[i] + j
+        jobs = []
+        for prompt, seed in zip(prompts, seeds):
+            for j in range(num_images_per_prompt):
+                generator = torch.Generator("cuda")
+                if seed is not None:
+                    generator.manual_seed(seed + j)
+                else:
+                    generator.seed()
+                jobs.append((prompt, generator))
+
+        # Run the batch in chunks; each chunk's images are encoded on the
+        # worker threads while the next chunk denoises
+        futures = []
+        for start in range(0, len(jobs), self.max_batch_size):
+            chunk = jobs[start:start + self.max_batch_size]
+            images = self.pipe(
+                [prompt for prompt, _ in chunk],
+                height=height,
+                width=width,
+                guidance_scale=guidance_scale,
+                num_inference_steps=num_inference_steps,
+                generator=[generator for _, generator in chunk],
+            ).images
+            futures.extend(
+                self.encoder.submit(encode_image, image, output_format, quality=quality, compress_level=compress_level)
+                for image in images
+            )
+        return [future.result() for future in futures]
+
     @modal.method()
     def generate(
         self,
@@ -70,22 +124,43 @@ class ImageGenerator:
         guidance_scale: float = 3.5,
         num_inference_steps: int = 50,
         seed: int | None = None,
-    ) -> bytes:
-        generator = torch.Generator("cuda").manual_seed(seed) if seed is not None else None
+        output_format: str = "png",
+        quality: int = 90,
+        compress_level: int = 6,
+    ):
+        return self._generate(
+            [prompt], height, width, guidance_scale, num_inference_steps, [seed], 1,
+            output_format, quality, compress_level,
+        )[0]
 
-        image = self.pipe(
-            prompt,
-            height=height,
-            width=width,
-            guidance_scale=guidance_scale,
-            num_inference_steps=num_inference_steps,
-            generator=generator,
-        ).images[0]
-
-        from io import BytesIO
-        buffer = BytesIO()
-        image.save(buffer, format="PNG")
-        return buffer.getvalue()
+    @modal.method()
+    def generate_batch(
+        self,
+        prompts: list[str],
+        height: int = 1024,
+        width: int = 1024,
+        guidance_scale: float = 3.5,
+        num_inference_steps: int = 50,
+        seeds: list[int | None] | None = None,
+        num_images_per_prompt: int = 1,
+        output_format: str = "png",
+        quality: int = 90,
+        compress_level: int = 6,
+    ) -> list:
+        """
+        Generate num_images_per_prompt images per prompt, ordered by prompt, in pipeline calls of
+        up to max_batch_size images.
+
+        Images are encoded as output_format: "png", "webp", "jpeg" or "raw" (.npy bytes of a uint8 array).
+        """
+        if seeds is None:
+            seeds = [None] * len(prompts)
+        if len(seeds) != len(prompts):
+            raise ValueError(f"Got {len(seeds)} seeds for {len(prompts)} prompts")
+        return self._generate(
+            prompts, height, width, guidance_scale, num_inference_steps, seeds, num_images_per_prompt,
+            output_format, quality, compress_level,
+        )
 
 
 @app.local_entrypoint()
@@ -93,13 +168,29 @@ def main(
     prompt: str = "a photo of a cat wearing a tiny hat",
     output: str = None,
     seed: int = None,
+    num_images: int = 1,
+    format: str = "png",
+    quality: int = 90,
 ):
+    from image_encoding import FORMAT_EXTENSIONS, write_output
     from utils import get_output_path
 
+    ext = FORMAT_EXTENSIONS[format]
     print(f"Generating: {prompt}")
     generator = ImageGenerator()
-    image_bytes = generator.generate.remote(prompt, seed=seed)
+    if num_images == 1:
+        image_bytes = generator.generate.remote(prompt, seed=seed, output_format=format, quality=quality)
+
+        output_path = get_output_path(prompt, output, prefix="flux", ext=ext)
+        write_output(image_bytes, output_path)
+        print(f"Saved to {output_path}")
+        return
 
-    output_path = get_output_path(prompt, output, prefix="flux")
-    output_path.write_bytes(image_bytes)
-    print(f"Saved to {output_path}")
+    images = generator.generate_batch.remote(
+        [prompt], seeds=[seed], num_images_per_prompt=num_images, output_format=format, quality=quality,
+    )
+    for j, image_bytes in enumerate(images):
+        numbered = f"{os.path.splitext(output)[0]}_{j}.{ext}" if output else None
+        output_path = get_output_path(prompt, numbered, prefix=f"flux_{j}", ext=ext)
+        write_output(image_bytes, output_path)
+        print(f"Saved to {output_path}")
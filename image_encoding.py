@@ -0,0 +1,65 @@
+"""
+Image encoding shared by the generation scripts.
+
+Encodes PIL images as PNG (with a zlib compression level), WebP or JPEG
+(with a quality setting), or as raw uint8 arrays in .npy format. ImageEncoder
+runs the encoding on a thread pool so it overlaps with the next generation;
+Pillow releases the GIL while compressing.
+"""
+
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+OUTPUT_FORMATS = ("png", "webp", "jpeg", "raw")
+
+# File extension for each output format when writing results to disk
+FORMAT_EXTENSIONS = {"png": "png", "webp": "webp", "jpeg": "jpg", "raw": "npy"}
+
+
+def check_output_format(output_format: str):
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format '{output_format}', expected one of {OUTPUT_FORMATS}")
+
+
+def encode_image(image, output_format: str = "png", quality: int = 90, compress_level: int = 6):
+    """
+    Encode a PIL image.
+
+    Returns file bytes in every format; raw is an (H, W, C) uint8 array saved
+    as .npy, so clients can write it to disk without numpy. compress_level
+    (0-9) only applies to PNG and quality (1-100) to WebP/JPEG.
+    """
+    check_output_format(output_format)
+
+    from io import BytesIO
+    buffer = BytesIO()
+    if output_format == "raw":
+        # Imported here so the local entrypoints don't need numpy
+        import numpy as np
+        np.save(buffer, np.array(image.convert("RGB"), dtype=np.uint8))
+    elif output_format == "png":
+        image.save(buffer, format="PNG", compress_level=compress_level)
+    elif output_format == "webp":
+        image.save(buffer, format="WEBP", quality=quality)
+    else:
+        image.convert("RGB").save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+def write_output(data: bytes, path):
+    """Write an encoded result to disk."""
+    path.write_bytes(data)
+
+
+class ImageEncoder:
+    """Encodes images on a thread pool and hands back futures."""
+
+    def __init__(self, max_workers: int = 4):
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="encode")
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        """Run fn (typically something that calls encode_image) off the calling thread."""
+        return self._pool.submit(fn, *args, **kwargs)
+
+    def shutdown(self):
+        self._pool.shutdown(wait=True)
@@ -11,14 +11,14 @@ def slugify(text: str, max_length: int = 50) -> str:
     return slug[:max_length]
 
 
-def get_output_path(prompt: str, output: str | None, prefix: str = "") -> Path:
+def get_output_path(prompt: str, output: str | None, prefix: str = "", ext: str = "png") -> Path:
     if output is None:
         slug = slugify(prompt)
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         if prefix:
-            output = f"output/{prefix}_{slug}_{timestamp}.png"
+            output = f"output/{prefix}_{slug}_{timestamp}.{ext}"
         else:
-            output = f"output/{slug}_{timestamp}.png"
+            output = f"output/{slug}_{timestamp}.{ext}"
 
     output_path = Path(output)
     output_path.parent.mkdir(parents=True, exist_ok=True)
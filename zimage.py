@@ -1,26 +1,98 @@
+import os
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
 import torch
 from diffusers import ZImagePipeline
-from safetensors.torch import load_file
 from transformers import pipeline as hf_pipeline
 
+from image_encoding import ImageEncoder, check_output_format, encode_image
+from zimage_lora import LoRARuntime, WeightSnapshot, prepare_lora
+
 
 class SafetyChecker:
-    def __init__(self, device: str = "cuda"):
+    def __init__(self, device: str = "cuda", batch_size: int = 8):
         self.classifier = hf_pipeline(
             "image-classification",
             model="Falconsai/nsfw_image_detection",
             device=device,
         )
+        self.batch_size = batch_size
+
+        # One worker keeps classifier calls ordered; its own stream lets the
+        # kernels overlap with the next denoising job on the default stream
+        self._worker = ThreadPoolExecutor(max_workers=1, thread_name_prefix="safety")
+        self._stream = torch.cuda.Stream() if str(device).startswith("cuda") else None
 
     def check(self, image) -> dict:
         """Return NSFW scores for an image."""
-        results = self.classifier(image)
-        # Convert list of {label, score} to dict
-        return {r["label"]: r["score"] for r in results}
+        return self.check_batch([image])[0]
+
+    def check_batch(self, images: list) -> list[dict]:
+        """Return NSFW scores for each image, classified in batches."""
+        results = self.classifier(images, batch_size=self.batch_size)
+        # Convert lists of {label, score} to dicts
+        return [{r["label"]: r["score"] for r in scores} for scores in results]
+
+    def submit(self, images: list) -> Future:
+        """Classify images on the worker thread; the future resolves to check_batch()'s result."""
+        return self._worker.submit(self._check_on_stream, images)
+
+    def _check_on_stream(self, images: list) -> list[dict]:
+        if self._stream is None:
+            return self.check_batch(images)
+        with torch.cuda.stream(self._stream):
+            return self.check_batch(images)
+
+
+class ByteLRUCache:
+    """Least-recently-used cache bounded by the total size of its values in bytes."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._entries = OrderedDict()  # key -> (value, nbytes)
+
+    def __contains__(self, key) -> bool:
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key, value, nbytes: int):
+        if key in self._entries:
+            self.total_bytes -= self._entries.pop(key)[1]
+        if nbytes > self.max_bytes:
+            return  # Too large to ever fit
+        self._entries[key] = (value, nbytes)
+        self.total_bytes += nbytes
+        while self.total_bytes > self.max_bytes:
+            _, (_, evicted_bytes) = self._entries.popitem(last=False)
+            self.total_bytes -= evicted_bytes
 
 
 class ZImageModel:
-    def __init__(self, model_id: str, cache_dir: str, device: str = "cuda"):
+    def __init__(
+        self,
+        model_id: str,
+        cache_dir: str,
+        device: str = "cuda",
+        lora_cache_bytes: int = 4 * 1024**3,
+        cache_lora_deltas: bool = False,
+        lora_mode: str = "merged",
+        exact_unload: bool = True,
+        encode_workers: int = 4,
+        prompt_cache_bytes: int = 256 * 1024**2,
+        max_sequence_length: int = 512,
+        max_batch_size: int = 4,
+    ):
         torch.backends.cuda.matmul.allow_tf32 = True
         self.pipe = ZImagePipeline.from_pretrained(
             model_id,
@@ -29,120 +101,169 @@ class ZImageModel:
         )
         self.pipe.to(device)
         self._lora_state = None
+        self._lora_key = None
+        self._lora_scale = 1.0
+
+        # Recently used LoRAs, with factors already on the device
+        self._lora_cache = ByteLRUCache(lora_cache_bytes)
+        self._cache_lora_deltas = cache_lora_deltas
+
+        # "merged" folds LoRAs into the weights; "runtime" runs them as side branches
+        if lora_mode not in ("merged", "runtime"):
+            raise ValueError(f"Unknown LoRA mode '{lora_mode}', expected 'merged' or 'runtime'")
+        self.lora_mode = lora_mode
+        self._lora_runtime = LoRARuntime() if lora_mode == "runtime" else None
+
+        # Pinned host copy of the weights a merged LoRA touches, for exact unloads
+        self._weight_snapshot = WeightSnapshot() if lora_mode == "merged" and exact_unload else None
+
+        # Images are encoded off the GPU thread, overlapping the next generation
+        self._encoder = ImageEncoder(max_workers=encode_workers)
+
+        # Prompt embeddings don't depend on the LoRA (it only touches the
+        # transformer), so repeated prompts skip the text encoder
+        self._prompt_cache = ByteLRUCache(prompt_cache_bytes)
+        self.max_sequence_length = max_sequence_length
+
+        # Images per pipeline call in generate_batch; each chunk's safety check
+        # and encoding run while the next chunk denoises
+        self.max_batch_size = max_batch_size
+
+    @staticmethod
+    def _lora_key_for(lora_path: str):
+        # Include the modification time so a rewritten file is not served stale
+        return (os.path.realpath(lora_path), os.path.getmtime(lora_path))
+
+    def _get_lora(self, lora_path: str):
+        """Return a prepared (unmerged) LoRA and its cache key, loading it on a miss."""
+        key = self._lora_key_for(lora_path)
+        lora = self._lora_cache.get(key)
+        if lora is None:
+            lora = prepare_lora(self.pipe.transformer, lora_path)
+            if self._cache_lora_deltas and self.lora_mode == "merged":
+                lora.cache_deltas()
+            self._lora_cache.put(key, lora, lora.nbytes)
+        return lora, key
 
     def load_lora(self, lora_path: str, scale: float = 1.0):
-        """Load LoRA weights by directly merging into model weights."""
-        state_dict = load_file(lora_path)
-
-        # Get LoRA rank and alpha from the weights
-        lora_rank = None
-        for key, value in state_dict.items():
-            if "lora_A" in key or "lora_down" in key:
-                lora_rank = value.shape[0]
-                break
-
-        if lora_rank is None:
-            raise ValueError("Could not determine LoRA rank from weights")
-
-        # Default alpha to rank (common convention)
-        lora_alpha = lora_rank
-
-        # Compute the scaling factor
-        lora_scale = scale * (lora_alpha / lora_rank)
-
-        # Group lora_A and lora_B pairs
-        lora_pairs = {}
-        for key, value in state_dict.items():
-            # Normalize key - remove diffusion_model. prefix if present
-            base_key = key.replace("diffusion_model.", "")
-
-            if ".lora_A." in base_key or ".lora_down." in base_key:
-                # Extract the module path (everything before .lora_A or .lora_down)
-                if ".lora_A." in base_key:
-                    module_path = base_key.split(".lora_A.")[0]
-                else:
-                    module_path = base_key.split(".lora_down.")[0]
-                if module_path not in lora_pairs:
-                    lora_pairs[module_path] = {}
-                lora_pairs[module_path]["A"] = value
-            elif ".lora_B." in base_key or ".lora_up." in base_key:
-                if ".lora_B." in base_key:
-                    module_path = base_key.split(".lora_B.")[0]
-                else:
-                    module_path = base_key.split(".lora_up.")[0]
-                if module_path not in lora_pairs:
-                    lora_pairs[module_path] = {}
-                lora_pairs[module_path]["B"] = value
-
-        # Apply LoRA weights by merging: W' = W + scale * (B @ A)
-        # Track applied deltas for rollback on error
-        transformer = self.pipe.transformer
-        applied = []  # [(module, delta), ...] for rollback
-        try:
-            for module_path, pair in lora_pairs.items():
-                if "A" not in pair or "B" not in pair:
-                    continue
-
-                # Navigate to the target module
-                parts = module_path.split(".")
-                module = transformer
-                for part in parts:
-                    if part.isdigit():
-                        module = module[int(part)]
-                    else:
-                        module = getattr(module, part)
-
-                # Check module has weights
-                if not hasattr(module, "weight"):
-                    raise ValueError(f"Module {module_path} has no weight attribute")
-
-                # Compute delta: B @ A, scaled
-                lora_A = pair["A"].to(module.weight.device, dtype=module.weight.dtype)
-                lora_B = pair["B"].to(module.weight.device, dtype=module.weight.dtype)
-                delta = (lora_B @ lora_A) * lora_scale
-
-                # Merge into weights
-                module.weight.data += delta
-                applied.append((module, delta))
-
-        except Exception:
-            # Rollback any applied deltas
-            for module, delta in applied:
-                module.weight.data -= delta
-            raise
-
-        # Store the pairs for potential unloading
-        self._lora_state = {"pairs": lora_pairs, "scale": lora_scale}
+        """Load LoRA weights by merging into model weights, or attaching them in runtime mode."""
+        # Same LoRA already active - only the strength changes. Checked before
+        # the cache lookup, which may return a fresh unmerged copy when the
+        # LoRA is too large to be cached.
+        if self._lora_state is not None and self._lora_key_for(lora_path) == self._lora_key:
+            if self._lora_runtime is not None:
+                self._lora_runtime.activate(self._lora_state, scale)
+                self._lora_scale = scale
+            else:
+                self._lora_state.rescale(scale)
+            return
+
+        lora, key = self._get_lora(lora_path)
+
+        if self._lora_runtime is not None:
+            # Only swaps references; base weights are untouched
+            self._lora_runtime.activate(lora, scale)
+            self._lora_state = lora
+            self._lora_key = key
+            self._lora_scale = scale
+            return
+
+        self.unload_lora()
+        lora.rescale(scale)
+        # Merging resolves every target before touching weights and rolls back on error
+        lora.merge(snapshot=self._weight_snapshot)
+        self._lora_state = lora
+        self._lora_key = key
 
     def unload_lora(self):
-        """Remove LoRA weights from the model by reversing the merge."""
+        """Remove LoRA weights from the model by restoring the snapshot or reversing the merge."""
         if self._lora_state is None:
             return
 
-        lora_pairs = self._lora_state["pairs"]
-        lora_scale = self._lora_state["scale"]
-        transformer = self.pipe.transformer
+        if self._lora_runtime is not None:
+            self._lora_runtime.deactivate()
+        else:
+            self._lora_state.unmerge()
+        self._lora_state = None
+        self._lora_key = None
 
-        for module_path, pair in lora_pairs.items():
-            if "A" not in pair or "B" not in pair:
-                continue
+    def set_lora(self, lora_path: str | None, scale: float = 1.0):
+        """Make the given LoRA (or none) active, doing only the work that changed."""
+        if lora_path is None:
+            self.unload_lora()
+        else:
+            self.load_lora(lora_path, scale=scale)
 
-            # Navigate to the target module
-            parts = module_path.split(".")
-            module = transformer
-            for part in parts:
-                if part.isdigit():
-                    module = module[int(part)]
+    def _encode_prompts(self, prompts: list[str]) -> list[torch.Tensor]:
+        """Return per-prompt text embeddings, encoding only prompts missing from the cache."""
+        keys = [(prompt, self.max_sequence_length) for prompt in prompts]
+        embeds = {key: self._prompt_cache.get(key) for key in keys}
+
+        missing = list(dict.fromkeys(key for key, value in embeds.items() if value is None))
+        if missing:
+            with torch.no_grad():
+                encoded, _ = self.pipe.encode_prompt(
+                    prompt=[prompt for prompt, _ in missing],
+                    device=self.pipe.device,
+                    do_classifier_free_guidance=False,
+                    max_sequence_length=self.max_sequence_length,
+                )
+            for key, value in zip(missing, encoded):
+                embeds[key] = value
+                self._prompt_cache.put(key, value, value.numel() * value.element_size())
+
+        return [embeds[key] for key in keys]
+
+    @staticmethod
+    def _make_generators(seeds: list[int | None], num_images_per_prompt: int = 1) -> list:
+        """One generator per image; image j of prompt i is seeded with seeds[i] + j."""
+        generators = []
+        for seed in seeds:
+            for j in range(num_images_per_prompt):
+                generator = torch.Generator("cuda")
+                if seed is not None:
+                    generator.manual_seed(seed + j)
                 else:
-                    module = getattr(module, part)
+                    generator.seed()
+                generators.append(generator)
+        return generators
 
-            # Compute delta and subtract it
-            lora_A = pair["A"].to(module.weight.device, dtype=module.weight.dtype)
-            lora_B = pair["B"].to(module.weight.device, dtype=module.weight.dtype)
-            delta = (lora_B @ lora_A) * lora_scale
-            module.weight.data -= delta
+    @staticmethod
+    def _encode_result(
+        image,
+        safety_future: Future | None,
+        index: int,
+        output_format: str,
+        quality: int,
+        compress_level: int,
+    ) -> dict:
+        image_bytes = encode_image(image, output_format, quality=quality, compress_level=compress_level)
+        return {
+            "image_bytes": image_bytes,
+            "format": output_format,
+            "safety_scores": safety_future.result()[index] if safety_future is not None else None,
+        }
 
-        self._lora_state = None
+    def _submit_results(
+        self,
+        images: list,
+        safety_checker: SafetyChecker | None,
+        output_format: str,
+        quality: int,
+        compress_level: int,
+        wait: bool,
+    ) -> list:
+        # Run safety check if provided, as one batch on the checker's worker
+        safety_future = safety_checker.submit(images) if safety_checker else None
+        futures = [
+            self._encoder.submit(
+                self._encode_result, image, safety_future, i, output_format, quality, compress_level
+            )
+            for i, image in enumerate(images)
+        ]
+        if wait:
+            return [future.result() for future in futures]
+        return futures
 
     def generate(
         self,
@@ -152,28 +273,124 @@ class ZImageModel:
         num_inference_steps: int = 9,
         seed: int | None = None,
         safety_checker: SafetyChecker | None = None,
-    ) -> dict:
-        generator = torch.Generator("cuda").manual_seed(seed) if seed is not None else None
-
-        image = self.pipe(
-            prompt=prompt,
+        output_format: str = "png",
+        quality: int = 90,
+        compress_level: int = 6,
+        wait: bool = True,
+    ):
+        return self.generate_batch(
+            [prompt],
             height=height,
             width=width,
             num_inference_steps=num_inference_steps,
-            guidance_scale=0.0,
-            generator=generator,
-        ).images[0]
+            seeds=[seed],
+            safety_checker=safety_checker,
+            output_format=output_format,
+            quality=quality,
+            compress_level=compress_level,
+            wait=wait,
+        )[0]
+
+    def generate_batch(
+        self,
+        prompts: list[str],
+        height: int = 1024,
+        width: int = 1024,
+        num_inference_steps: int = 9,
+        seeds: list[int | None] | None = None,
+        num_images_per_prompt: int = 1,
+        safety_checker: SafetyChecker | None = None,
+        output_format: str = "png",
+        quality: int = 90,
+        compress_level: int = 6,
+        wait: bool = True,
+    ) -> list:
+        """
+        Generate num_images_per_prompt images for each prompt, in pipeline calls
+        of up to max_batch_size images.
 
-        # Run safety check if provided
-        safety_scores = None
-        if safety_checker:
-            safety_scores = safety_checker.check(image)
+        Every image gets its own generator, so image j of prompt i is the same
+        image that generate() returns for seed seeds[i] + j. Results are ordered
+        by prompt, then by image.
 
-        from io import BytesIO
-        buffer = BytesIO()
-        image.save(buffer, format="PNG")
+        Images are encoded on a thread pool as output_format ("png", "webp",
+        "jpeg" or "raw" uint8 arrays as .npy bytes). With wait=False, futures
+        of the result dicts are returned immediately so encoding overlaps the
+        caller's next generation.
+        """
+        check_output_format(output_format)
+        if seeds is None:
+            seeds = [None] * len(prompts)
+        if len(seeds) != len(prompts):
+            raise ValueError(f"Got {len(seeds)} seeds for {len(prompts)} prompts")
 
-        return {
-            "image_bytes": buffer.getvalue(),
-            "safety_scores": safety_scores,
-        }
+        # One (prompt, generator) job per image, in prompt-then-image order
+        image_prompts = [prompt for prompt in prompts for _ in range(num_images_per_prompt)]
+        jobs = list(zip(image_prompts, self._make_generators(seeds, num_images_per_prompt)))
+
+        # Each chunk's safety batch and encoding are submitted before the next
+        # chunk starts denoising, so they overlap it
+        futures = []
+        for start in range(0, len(jobs), self.max_batch_size):
+            chunk = jobs[start:start + self.max_batch_size]
+            images = self.pipe(
+                prompt_embeds=self._encode_prompts([prompt for prompt, _ in chunk]),
+                height=height,
+                width=width,
+                num_inference_steps=num_inference_steps,
+                guidance_scale=0.0,
+                generator=[generator for _, generator in chunk],
+            ).images
+            futures.extend(
+                self._submit_results(images, safety_checker, output_format, quality, compress_level, wait=False)
+            )
+
+        if wait:
+            return [future.result() for future in futures]
+        return futures
+
+    def generate_multi_lora(
+        self,
+        requests: list[dict],
+        height: int = 1024,
+        width: int = 1024,
+        num_inference_steps: int = 9,
+        output_format: str = "png",
+        quality: int = 90,
+        compress_level: int = 6,
+        wait: bool = True,
+    ) -> list:
+        """
+        Generate one image per request in a single batched denoising loop.
+
+        Each request is {"prompt": str, "lora": path or None, "scale": float,
+        "seed": int or None}, so requests for different LoRAs share the same
+        forward passes. Requires lora_mode="runtime". Results are returned in
+        request order, in the same format as generate_batch().
+        """
+        check_output_format(output_format)
+        if self._lora_runtime is None:
+            raise ValueError('Multi-LoRA batches require ZImageModel(lora_mode="runtime")')
+
+        loras = [self._get_lora(r["lora"])[0] if r.get("lora") else None for r in requests]
+        scales = [r.get("scale", 1.0) for r in requests]
+        generators = self._make_generators([r.get("seed") for r in requests])
+
+        self._lora_runtime.activate_batch(loras, scales)
+        try:
+            images = self.pipe(
+                prompt_embeds=self._encode_prompts([r["prompt"] for r in requests]),
+                height=height,
+                width=width,
+                num_inference_steps=num_inference_steps,
+                guidance_scale=0.0,
+                generator=generators,
+            ).images
+        finally:
+            # Restore the single-LoRA state from before the batch
+            if self._lora_state is not None:
+                self._lora_runtime.activate(self._lora_state, self._lora_scale)
+            else:
+                self._lora_runtime.deactivate()
+
+        return self._submit_results(images, None, output_format, quality, compress_level, wait)
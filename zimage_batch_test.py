@@ -4,10 +4,13 @@ Loads the model ONCE, then tests multiple LoRAs/scales/prompts.
 
 Usage:
     uv run modal run zimage_batch_test.py
+    uv run modal run zimage_batch_test.py --shards 4   # fan out across 4 GPUs
+    uv run modal run zimage_batch_test.py --output-dir output/my_run   # rerun to resume
 """
 
 import os
 import modal
+from collections import deque
 from pathlib import Path
 
 if modal.is_local():
@@ -45,12 +48,122 @@ image = (
         "HF_HOME": CACHE_DIR,
     })
     .add_local_file("zimage.py", "/root/zimage.py")
+    .add_local_file("zimage_lora.py", "/root/zimage_lora.py")
+    .add_local_file("image_encoding.py", "/root/image_encoding.py")
 )
 
 with image.imports():
     from zimage import ZImageModel, SafetyChecker
 
 
+def schedule_tests(tests: list[dict]) -> list[int]:
+    """
+    Return the indices of tests in the order they should run.
+
+    Groups by LoRA (baseline first, then LoRAs in order of first appearance),
+    then by scale, then by prompt, so each LoRA is loaded once and each scale
+    is set once per LoRA. Ties keep their original order.
+    """
+    first_seen = {}
+    for test in tests:
+        first_seen.setdefault(("lora", test.get("lora")), len(first_seen))
+        first_seen.setdefault(("prompt", test["prompt"]), len(first_seen))
+
+    def cost_key(i):
+        test = tests[i]
+        lora = test.get("lora")
+        return (
+            lora is not None,
+            first_seen[("lora", lora)],
+            test.get("scale", 1.0),
+            first_seen[("prompt", test["prompt"])],
+            i,
+        )
+
+    return sorted(range(len(tests)), key=cost_key)
+
+
+def partition_tests(tests: list[dict], num_shards: int) -> list[list[int]]:
+    """
+    Split test indices into at most num_shards shards without splitting a LoRA.
+
+    Each LoRA's tests (and the baseline's) stay together so every LoRA is
+    loaded in one container. Groups are placed largest first on the least
+    loaded shard. Empty shards are dropped.
+    """
+    groups = {}
+    for i, test in enumerate(tests):
+        groups.setdefault(test.get("lora"), []).append(i)
+
+    shards = [[] for _ in range(max(1, num_shards))]
+    for group in sorted(groups.values(), key=len, reverse=True):
+        min(shards, key=len).extend(group)
+    return [sorted(shard) for shard in shards if shard]
+
+
+class LocalMapper:
+    """
+    In-process stand-in for a Modal function's .map(), for exercising
+    run_sharded without GPUs (e.g. LocalMapper(fake_run_tests)).
+    """
+
+    def __init__(self, fn):
+        self.fn = fn
+
+    def map(self, inputs, kwargs: dict | None = None, return_exceptions: bool = False):
+        for item in inputs:
+            try:
+                yield self.fn(item, **(kwargs or {}))
+            except Exception as e:
+                if not return_exceptions:
+                    raise
+                yield e
+
+
+def run_sharded(
+    run_tests,
+    tests: list[dict],
+    num_shards: int,
+    max_retries: int = 2,
+    **kwargs,
+):
+    """
+    Run tests as shards through run_tests.map, yielding (index, result) pairs.
+
+    run_tests is the BatchTester.run_tests Modal method (or a LocalMapper).
+    Each shard's results are yielded as soon as its .map output arrives, so
+    the caller can save them before later shards finish. Shards that raise
+    are retried up to max_retries times; shards that already finished are not
+    rerun. Tests in shards that never succeed get an error result.
+    """
+    shards = partition_tests(tests, num_shards)
+    pending = list(range(len(shards)))
+
+    for attempt in range(max_retries + 1):
+        if not pending:
+            break
+        if attempt:
+            print(f"Retrying {len(pending)} failed shard(s) (attempt {attempt + 1})")
+
+        outputs = run_tests.map(
+            [[tests[i] for i in shards[s]] for s in pending],
+            kwargs=kwargs,
+            return_exceptions=True,
+        )
+        failed = []
+        for s, output in zip(pending, outputs):
+            if isinstance(output, BaseException):
+                print(f"Shard {s} failed: {output}")
+                failed.append(s)
+                continue
+            yield from zip(shards[s], output)
+        pending = failed
+
+    for s in pending:
+        for i in shards[s]:
+            yield i, {"error": f"Shard {s} failed after {max_retries + 1} attempts"}
+
+
 @app.cls(
     #gpu="A100-80GB",
     gpu="h100",
@@ -70,8 +183,77 @@ class BatchTester:
         self.model = ZImageModel(MODEL_ID, CACHE_DIR)
         print("Model loaded and ready for batch testing")
 
+    def _iter_tests(self, tests: list[dict], output_format: str, quality: int, batch_size: int):
+        """
+        Run tests in scheduled order, yielding (index, result) as each image finishes encoding.
+
+        Consecutive tests with the same LoRA and scale run as one generate_batch
+        call of up to batch_size images.
+        """
+        # Run in an order that minimizes LoRA swaps and rescales
+        batches = []
+        for i in schedule_tests(tests):
+            key = (tests[i].get("lora"), tests[i].get("scale", 1.0))
+            if batches and batches[-1][0] == key and len(batches[-1][1]) < batch_size:
+                batches[-1][1].append(i)
+            else:
+                batches.append((key, [i]))
+
+        # Encoding finishes on a worker thread while the next batch generates
+        pending = deque()
+        done = 0
+
+        for (lora, scale), indices in batches:
+            print(f"\n[{done+1}-{done+len(indices)}/{len(tests)}] Testing: lora={lora}, scale={scale}")
+            done += len(indices)
+
+            lora_path = None
+            if lora is not None:
+                lora_path = f"{LORA_DIR}/{lora}.safetensors"
+                if not os.path.exists(lora_path):
+                    print(f"  WARNING: LoRA not found: {lora_path}")
+                    for i in indices:
+                        yield i, {"error": f"LoRA not found: {lora}"}
+                    continue
+
+            # Loads, swaps or rescales only when the LoRA or scale changed
+            self.model.set_lora(lora_path, scale=scale)
+
+            prompts = [tests[i]["prompt"] for i in indices]
+            seeds = [tests[i].get("seed", 42) for i in indices]
+            for prompt in prompts:
+                print(f"  Prompt: {prompt[:50]}...")
+
+            futures = self.model.generate_batch(
+                prompts,
+                seeds=seeds,
+                output_format=output_format,
+                quality=quality,
+                wait=False,
+            )
+            for i, prompt, seed, future in zip(indices, prompts, seeds, futures):
+                pending.append((i, {"lora": lora, "scale": scale, "prompt": prompt, "seed": seed}, future))
+
+            print(f"  Done!")
+
+            while pending and pending[0][2].done():
+                i, result, future = pending.popleft()
+                yield i, {**result, "image_bytes": future.result()["image_bytes"]}
+
+        # Cleanup
+        self.model.unload_lora()
+
+        for i, result, future in pending:
+            yield i, {**result, "image_bytes": future.result()["image_bytes"]}
+
     @modal.method()
-    def run_tests(self, tests: list[dict]) -> list[dict]:
+    def run_tests(
+        self,
+        tests: list[dict],
+        output_format: str = "png",
+        quality: int = 90,
+        batch_size: int = 4,
+    ) -> list[dict]:
         """
         Run multiple tests on the same loaded model.
 
@@ -82,70 +264,65 @@ class BatchTester:
             "seed": int,
         }
 
-        Returns list of results with image bytes.
+        Tests run grouped by LoRA, then scale, then prompt (see schedule_tests),
+        up to batch_size images per pipeline call, but results are returned in
+        the order given: a list of results with
+        image bytes in output_format.
         """
-        results = []
-        current_lora = None
-
-        for i, test in enumerate(tests):
-            lora = test.get("lora")
-            scale = test.get("scale", 1.0)
-            prompt = test["prompt"]
-            seed = test.get("seed", 42)
-
-            print(f"\n[{i+1}/{len(tests)}] Testing: lora={lora}, scale={scale}")
-            print(f"  Prompt: {prompt[:50]}...")
-
-            # Load/unload LoRA only if changed
-            if lora != current_lora:
-                if current_lora is not None:
-                    self.model.unload_lora()
-
-                if lora is not None:
-                    lora_path = f"{LORA_DIR}/{lora}.safetensors"
-                    if os.path.exists(lora_path):
-                        self.model.load_lora(lora_path, scale=scale)
-                    else:
-                        print(f"  WARNING: LoRA not found: {lora_path}")
-                        results.append({"error": f"LoRA not found: {lora}"})
-                        continue
-
-                current_lora = lora
-            elif lora is not None and scale != test.get("_prev_scale"):
-                # Same LoRA but different scale - reload with new scale
-                self.model.unload_lora()
-                lora_path = f"{LORA_DIR}/{lora}.safetensors"
-                self.model.load_lora(lora_path, scale=scale)
-
-            test["_prev_scale"] = scale
-
-            # Generate
-            result = self.model.generate(
-                prompt=prompt,
-                seed=seed,
-            )
-
-            results.append({
-                "lora": lora,
-                "scale": scale,
-                "prompt": prompt,
-                "seed": seed,
-                "image_bytes": result["image_bytes"],
-            })
-
-            print(f"  Done!")
+        results = [None] * len(tests)
+        for i, result in self._iter_tests(tests, output_format, quality, batch_size):
+            results[i] = result
+        return results
 
-        # Cleanup
-        if current_lora is not None:
-            self.model.unload_lora()
+    @modal.method()
+    def stream_tests(
+        self,
+        tests: list[dict],
+        output_format: str = "png",
+        quality: int = 90,
+        batch_size: int = 4,
+    ):
+        """
+        Like run_tests, but yields each result as soon as its image is encoded.
 
-        return results
+        Results arrive in run order, each with an "index" into tests. Call with
+        .remote_gen() so the caller can save them as they arrive.
+        """
+        for i, result in self._iter_tests(tests, output_format, quality, batch_size):
+            yield {"index": i, **result}
+
+
+def output_filename(test: dict, index: int, ext: str) -> str:
+    """File name for a test's image: LoRA, scale and key words from the prompt."""
+    lora_name = test.get("lora") or "nolora"
+    scale = test.get("scale", 1.0)
+    prompt = test["prompt"].lower()
+    if "coffee" in prompt:
+        scene = "coffee"
+    elif "astronaut" in prompt or "lunar" in prompt or "moon" in prompt:
+        scene = "moon"
+    elif "t-rex" in prompt or "dinosaur" in prompt or "warrior" in prompt:
+        scene = "trex"
+    elif "victory" in prompt or "trophy" in prompt or "champion" in prompt:
+        scene = "victory"
+    else:
+        scene = f"prompt{index}"
+    return f"{lora_name}_s{scale}_{scene}.{ext}"
 
 
 @app.local_entrypoint()
-def main():
+def main(
+    format: str = "png",
+    quality: int = 90,
+    shards: int = 1,
+    retries: int = 2,
+    output_dir: str = None,
+    batch_size: int = 4,
+):
     from datetime import datetime
 
+    from image_encoding import FORMAT_EXTENSIONS, write_output
+
     # === CONFIGURE YOUR TESTS HERE ===
 
     loras = [
@@ -195,37 +372,45 @@ def main():
     print(f"Running {len(tests)} tests...")
     print(f"  {len(loras)} LoRAs × {len(scales)} scales × {len(prompts)} prompts + {len(prompts)} baseline")
 
-    # Run batch
-    tester = BatchTester()
-    results = tester.run_tests.remote(tests)
-
-    # Save results
-    output_dir = Path("output/batch_test_" + datetime.now().strftime("%Y%m%d_%H%M%S"))
+    # A stable output dir lets a restarted run skip finished tests
+    if output_dir is None:
+        output_dir = "output/batch_test_" + datetime.now().strftime("%Y%m%d_%H%M%S")
+    output_dir = Path(output_dir)
     output_dir.mkdir(parents=True, exist_ok=True)
 
-    for i, r in enumerate(results):
+    ext = FORMAT_EXTENSIONS[format]
+    paths = [output_dir / output_filename(test, i, ext) for i, test in enumerate(tests)]
+    todo = [i for i, path in enumerate(paths) if not path.exists()]
+    if len(todo) < len(tests):
+        print(f"Skipping {len(tests) - len(todo)} tests with existing outputs in {output_dir}/")
+
+    def save(i, r):
         if "error" in r:
             print(f"Error: {r['error']}")
-            continue
-
-        lora_name = r["lora"] or "nolora"
-        scale = r["scale"]
-        # Use index + key words from prompt to make unique filename
-        prompt = r["prompt"].lower()
-        if "coffee" in prompt:
-            scene = "coffee"
-        elif "astronaut" in prompt or "lunar" in prompt or "moon" in prompt:
-            scene = "moon"
-        elif "t-rex" in prompt or "dinosaur" in prompt or "warrior" in prompt:
-            scene = "trex"
-        elif "victory" in prompt or "trophy" in prompt or "champion" in prompt:
-            scene = "victory"
-        else:
-            scene = f"prompt{i}"
-
-        filename = f"{lora_name}_s{scale}_{scene}.png"
-        filepath = output_dir / filename
-        filepath.write_bytes(r["image_bytes"])
-
-    print(f"\nSaved {len(results)} images to {output_dir}/")
+            return False
+        # Write then rename, so an interrupted run never leaves a partial file to skip
+        partial = paths[i].with_name(f"{paths[i].stem}.partial{paths[i].suffix}")
+        write_output(r["image_bytes"], partial)
+        os.replace(partial, paths[i])
+        return True
+
+    # Run batch, optionally partitioned by LoRA across containers
+    tester = BatchTester()
+    todo_tests = [tests[i] for i in todo]
+    saved = 0
+    if shards > 1:
+        # Save each shard's images as soon as that shard returns
+        for j, r in run_sharded(
+            tester.run_tests, todo_tests, shards, max_retries=retries,
+            output_format=format, quality=quality, batch_size=batch_size,
+        ):
+            saved += save(todo[j], r)
+    elif todo_tests:
+        # Write each image as soon as it arrives
+        for r in tester.stream_tests.remote_gen(
+            todo_tests, output_format=format, quality=quality, batch_size=batch_size,
+        ):
+            saved += save(todo[r["index"]], r)
+
+    print(f"\nSaved {saved} images to {output_dir}/")
     print("Open the folder and compare!")
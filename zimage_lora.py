@@ -0,0 +1,421 @@
+"""
+LoRA weight merging shared by training and inference.
+
+Parses LoRA state dicts in the common key layouts (PEFT lora_A/lora_B,
+lora_down/lora_up with optional alpha, diffusers/"diffusion_model." prefixes
+and kohya underscore names), resolves the target modules through a single
+named_modules() index, and merges, unmerges or rescales all layers with
+batched matmuls over groups of same-shaped layers. WeightSnapshot keeps
+pinned host copies of the touched weights so a merge can be undone exactly.
+LoRARuntime applies the same factors as unmerged side branches instead.
+"""
+
+import itertools
+import re
+from collections import defaultdict
+
+import torch
+from safetensors.torch import load_file
+
+
+# Prefixes that different trainers put in front of the module path
+KEY_PREFIXES = (
+    "base_model.model.",
+    "diffusion_model.",
+    "transformer.",
+    "lora_unet_",
+    "lora_transformer_",
+)
+
+_FACTOR_KEY = re.compile(r"^(?P<module>.+?)\.(?P<kind>lora_A|lora_B|lora_down|lora_up)(?:\.default)?\.weight$")
+_ALPHA_KEY = re.compile(r"^(?P<module>.+)\.alpha$")
+
+# Upper bound on the temporary dense deltas computed in one batched matmul
+MAX_DELTA_BYTES = 1024**3
+
+# Most times a per-sample LoRA batch may be repeated along the leading
+# dimension (classifier-free guidance runs [cond, uncond])
+MAX_BATCH_REPEATS = 2
+
+
+def _strip_prefixes(module_key: str) -> str:
+    for prefix in KEY_PREFIXES:
+        if module_key.startswith(prefix):
+            module_key = module_key[len(prefix):]
+    return module_key
+
+
+def parse_lora_state_dict(state_dict: dict[str, torch.Tensor]) -> dict[str, dict]:
+    """
+    Group LoRA tensors by target module.
+
+    Returns {module_key: {"A": down, "B": up, "alpha": float or None}} for every
+    module that has both factors. Module keys are dotted paths, or underscore
+    paths for kohya-style files.
+    """
+    pairs = defaultdict(dict)
+    for key, value in state_dict.items():
+        match = _FACTOR_KEY.match(key)
+        if match:
+            factor = "A" if match["kind"] in ("lora_A", "lora_down") else "B"
+            pairs[_strip_prefixes(match["module"])][factor] = value
+            continue
+        match = _ALPHA_KEY.match(key)
+        if match:
+            pairs[_strip_prefixes(match["module"])]["alpha"] = float(value)
+
+    lora_pairs = {
+        module_key: {"A": pair["A"], "B": pair["B"], "alpha": pair.get("alpha")}
+        for module_key, pair in pairs.items()
+        if "A" in pair and "B" in pair
+    }
+    if not lora_pairs:
+        raise ValueError("No LoRA weight pairs found in state dict")
+    return lora_pairs
+
+
+def build_module_index(model: torch.nn.Module) -> dict[str, torch.nn.Module]:
+    """Map both dotted and kohya-style underscore names to modules in one pass."""
+    index = {}
+    for name, module in model.named_modules():
+        index[name] = module
+        index.setdefault(name.replace(".", "_"), module)
+    return index
+
+
+def resolve_lora(
+    model: torch.nn.Module,
+    lora_pairs: dict[str, dict],
+    device=None,
+    dtype: torch.dtype = None,
+) -> list[tuple[torch.nn.Module, torch.Tensor, torch.Tensor, float]]:
+    """
+    Resolve parsed LoRA pairs to (module, A, B, multiplier) targets.
+
+    Factors are moved to the module weight's device and dtype unless given.
+    The multiplier is alpha / rank when the file stores alpha, otherwise 1.
+    """
+    index = build_module_index(model)
+    targets = []
+    for module_key, pair in lora_pairs.items():
+        module = index.get(module_key)
+        if module is None:
+            raise ValueError(f"LoRA targets unknown module {module_key}")
+        if not hasattr(module, "weight"):
+            raise ValueError(f"Module {module_key} has no weight attribute")
+
+        weight = module.weight
+        lora_A = pair["A"].to(device or weight.device, dtype=dtype or weight.dtype)
+        lora_B = pair["B"].to(device or weight.device, dtype=dtype or weight.dtype)
+        rank = lora_A.shape[0]
+        multiplier = pair["alpha"] / rank if pair["alpha"] is not None else 1.0
+        targets.append((module, lora_A, lora_B, multiplier))
+    return targets
+
+
+class WeightSnapshot:
+    """
+    Pinned host-memory copies of module weights, restored with async copies.
+
+    Undoing a merge by subtracting the delta again leaves bf16 rounding error
+    in the weights, which builds up over many load/unload cycles. Restoring a
+    snapshot is exact and costs only a host-to-device copy. Pinned buffers are
+    reused across captures of the same modules.
+    """
+
+    def __init__(self):
+        self._buffers = {}
+        self.modules = []
+
+    @property
+    def nbytes(self) -> int:
+        return sum(buffer.nbytes for buffer in self._buffers.values())
+
+    def capture(self, modules: list[torch.nn.Module]):
+        # Only keep buffers for the modules in this capture
+        self._buffers = {m: self._buffers[m] for m in modules if m in self._buffers}
+        for module in modules:
+            weight = module.weight.data
+            buffer = self._buffers.get(module)
+            if buffer is None:
+                buffer = torch.empty(weight.shape, dtype=weight.dtype, device="cpu", pin_memory=True)
+                self._buffers[module] = buffer
+            # Stream-ordered before any later in-place update of the weight
+            buffer.copy_(weight, non_blocking=True)
+        self.modules = list(modules)
+
+    def restore(self):
+        for module in self.modules:
+            module.weight.data.copy_(self._buffers[module], non_blocking=True)
+
+
+class MergedLoRA:
+    """
+    A LoRA merged into model weights: W' = W + scale * multiplier * (B @ A).
+
+    Layers with the same factor shapes are stacked so each group's deltas come
+    from one batched matmul and are added with one foreach op. Keeps the
+    factors, so it can be rescaled or unmerged without reloading the file, and
+    can optionally keep the dense deltas too so merges skip the matmuls.
+    """
+
+    def __init__(self, targets: list[tuple[torch.nn.Module, torch.Tensor, torch.Tensor, float]], scale: float = 1.0):
+        self.scale = scale
+        self.merged = False
+        self.num_layers = len(targets)
+        self._cached_deltas = None
+        self._snapshot = None
+
+        grouped = defaultdict(list)
+        for module, lora_A, lora_B, multiplier in targets:
+            grouped[(lora_A.shape, lora_B.shape, lora_A.device, lora_A.dtype)].append(
+                (module, lora_A, lora_B, multiplier)
+            )
+
+        self.groups = []
+        self.factors = {}  # module -> (A, B, multiplier), views into the stacks
+        for (_, b_shape, device, dtype), members in grouped.items():
+            modules = [m for m, _, _, _ in members]
+            A = torch.stack([a for _, a, _, _ in members])
+            B = torch.stack([b for _, _, b, _ in members])
+            multipliers = torch.tensor([mult for _, _, _, mult in members], device=device, dtype=dtype)
+            for i, (module, _, _, multiplier) in enumerate(members):
+                self.factors[module] = (A[i], B[i], multiplier)
+
+            # Bound the size of the dense deltas materialized at once
+            delta_bytes = b_shape[0] * A.shape[-1] * A.element_size()
+            chunk_size = max(1, MAX_DELTA_BYTES // delta_bytes)
+            self.groups.append((modules, A, B, multipliers, chunk_size))
+
+    @property
+    def nbytes(self) -> int:
+        """Device memory held by the factors (and dense deltas, if cached)."""
+        total = sum(A.nbytes + B.nbytes for _, A, B, _, _ in self.groups)
+        if self._cached_deltas is not None:
+            total += sum(deltas.nbytes for _, deltas in self._cached_deltas)
+        return total
+
+    def cache_deltas(self):
+        """Keep the dense deltas so later merges and unmerges skip the matmuls."""
+        if self._cached_deltas is None:
+            self._cached_deltas = list(self._compute_deltas())
+
+    def deltas(self):
+        """Yield (modules, deltas) chunks with deltas unscaled by the LoRA scale."""
+        if self._cached_deltas is not None:
+            yield from self._cached_deltas
+        else:
+            yield from self._compute_deltas()
+
+    def _compute_deltas(self):
+        for modules, A, B, multipliers, chunk_size in self.groups:
+            for start in range(0, len(modules), chunk_size):
+                end = start + chunk_size
+                deltas = torch.bmm(B[start:end], A[start:end]) * multipliers[start:end].view(-1, 1, 1)
+                yield modules[start:end], deltas
+
+    def _add(self, factor: float):
+        applied = 0
+        try:
+            for modules, deltas in self.deltas():
+                torch._foreach_add_([m.weight.data for m in modules], list(deltas.unbind(0)), alpha=factor)
+                applied += 1
+        except Exception:
+            # Roll back chunks that were already added (recomputed to keep memory bounded)
+            for modules, deltas in itertools.islice(self.deltas(), applied):
+                torch._foreach_add_([m.weight.data for m in modules], list(deltas.unbind(0)), alpha=-factor)
+            raise
+
+    def merge(self, snapshot: WeightSnapshot | None = None):
+        """Merge into the weights, first capturing them in snapshot if given."""
+        if not self.merged:
+            if snapshot is not None:
+                snapshot.capture(list(self.factors))
+            self._add(self.scale)
+            self._snapshot = snapshot
+            self.merged = True
+
+    def unmerge(self):
+        if self.merged:
+            if self._snapshot is not None:
+                self._snapshot.restore()
+            else:
+                self._add(-self.scale)
+            self._snapshot = None
+            self.merged = False
+
+    def rescale(self, scale: float):
+        """Change the strength of a merged LoRA by adding only the difference."""
+        if self.merged and scale != self.scale:
+            if self._snapshot is not None:
+                # Re-merge from the exact original weights
+                self._snapshot.restore()
+                self._add(scale)
+            else:
+                self._add(scale - self.scale)
+        self.scale = scale
+
+
+def prepare_lora(
+    model: torch.nn.Module,
+    lora: str | dict[str, torch.Tensor],
+    scale: float = 1.0,
+    device=None,
+    dtype: torch.dtype = None,
+) -> MergedLoRA:
+    """Load a LoRA file or state dict and resolve it against the model, without merging."""
+    state_dict = load_file(lora) if isinstance(lora, str) else lora
+    targets = resolve_lora(model, parse_lora_state_dict(state_dict), device=device, dtype=dtype)
+    return MergedLoRA(targets, scale=scale)
+
+
+def merge_lora(
+    model: torch.nn.Module,
+    lora: str | dict[str, torch.Tensor],
+    scale: float = 1.0,
+    device=None,
+    dtype: torch.dtype = None,
+    snapshot: WeightSnapshot | None = None,
+) -> MergedLoRA:
+    """Load a LoRA file or state dict and merge it into the model's weights."""
+    merged = prepare_lora(model, lora, scale=scale, device=device, dtype=dtype)
+    merged.merge(snapshot=snapshot)
+    return merged
+
+
+class LoRARuntime:
+    """
+    Applies a LoRA as low-rank side branches instead of merging it.
+
+    A forward hook on each target Linear adds scale * (x @ A.T) @ B.T to its
+    output. Base weights are never modified, and activating or switching
+    adapters only swaps a reference, so it costs O(1) rather than an O(d^2)
+    merge per layer. Hooks are installed once per module and stay in place.
+
+    activate_batch() instead gives every sample in the batch its own adapter
+    and scale: per layer the adapters' factors are stacked (zero-padded to the
+    largest rank), gathered by sample and applied with two batched matmuls, in
+    the style of segmented-gather (punica) LoRA kernels. This requires target
+    layers to see inputs with the batch as their leading dimension (repeated
+    at most MAX_BATCH_REPEATS times); layers fed packed tokens raise instead.
+    """
+
+    def __init__(self):
+        self._hooks = {}
+        self._factors = None
+        self._scale = 1.0
+        self._batch = None
+
+    @property
+    def active(self) -> bool:
+        return self._factors is not None or self._batch is not None
+
+    def _install_hooks(self, modules):
+        for module in modules:
+            if module not in self._hooks:
+                if not isinstance(module, torch.nn.Linear):
+                    raise ValueError(f"Runtime LoRA only supports Linear layers, got {type(module).__name__}")
+                self._hooks[module] = module.register_forward_hook(self._forward_hook)
+
+    def activate(self, lora: MergedLoRA, scale: float = 1.0):
+        self._install_hooks(lora.factors)
+        self._batch = None
+        self._factors = lora.factors
+        self._scale = scale
+
+    def activate_batch(self, loras: list[MergedLoRA | None], scales: list[float]):
+        """Give each sample of the following forward passes its own LoRA (or None) and scale."""
+        adapters = []
+        positions = {}
+        sample_index = []
+        sample_scales = []
+        for lora, scale in zip(loras, scales):
+            if lora is None:
+                sample_index.append(0)
+                sample_scales.append(0.0)
+                continue
+            if id(lora) not in positions:
+                positions[id(lora)] = len(adapters)
+                adapters.append(lora)
+            sample_index.append(positions[id(lora)])
+            sample_scales.append(scale)
+
+        self._factors = None
+        self._batch = None
+        if not adapters:
+            return
+
+        modules = {module for lora in adapters for module in lora.factors}
+        self._install_hooks(modules)
+
+        stacked = {}
+        for module in modules:
+            present = [lora.factors.get(module) for lora in adapters]
+            ref_A, ref_B, _ = next(f for f in present if f is not None)
+            rank = max(f[0].shape[0] for f in present if f is not None)
+
+            # Adapters that skip this layer keep zero factors
+            A_all = ref_A.new_zeros(len(adapters), rank, ref_A.shape[1])
+            B_all = ref_B.new_zeros(len(adapters), ref_B.shape[0], rank)
+            multipliers = torch.zeros(len(adapters), device=ref_A.device)
+            for k, factors in enumerate(present):
+                if factors is not None:
+                    lora_A, lora_B, multiplier = factors
+                    A_all[k, :lora_A.shape[0]] = lora_A
+                    B_all[k, :, :lora_A.shape[0]] = lora_B
+                    multipliers[k] = multiplier
+            stacked[module] = (A_all, B_all, multipliers)
+
+        device = ref_A.device
+        self._batch = (
+            stacked,
+            torch.tensor(sample_index, device=device),
+            torch.tensor(sample_scales, device=device),
+        )
+
+    def deactivate(self):
+        self._factors = None
+        self._batch = None
+
+    def remove_hooks(self):
+        for handle in self._hooks.values():
+            handle.remove()
+        self._hooks = {}
+        self._factors = None
+        self._batch = None
+
+    def _forward_hook(self, module, inputs, output):
+        if self._batch is not None:
+            return self._batched_forward(module, inputs[0], output)
+        if self._factors is None:
+            return None
+        factors = self._factors.get(module)
+        if factors is None:
+            return None
+        lora_A, lora_B, multiplier = factors
+        hidden = torch.nn.functional.linear(inputs[0].to(lora_A.dtype), lora_A)
+        return output + torch.nn.functional.linear(hidden * (self._scale * multiplier), lora_B).to(output.dtype)
+
+    def _batched_forward(self, module, x, output):
+        stacked, sample_index, sample_scales = self._batch
+        factors = stacked.get(module)
+        if factors is None:
+            return None
+        A_all, B_all, multipliers = factors
+
+        # Guidance may run the batch twice (e.g. [cond, uncond]). Any other
+        # leading dimension, such as packed token rows, can't be mapped to samples
+        num_samples = sample_index.shape[0]
+        repeats = x.shape[0] // num_samples
+        if x.shape[0] % num_samples or not 1 <= repeats <= MAX_BATCH_REPEATS:
+            raise RuntimeError(
+                f"{type(module).__name__} input has leading dimension {x.shape[0]}, which does not map "
+                f"onto {num_samples} per-sample LoRAs; batched LoRAs need layers with a batch dimension"
+            )
+        index = sample_index.repeat(repeats)
+        scales = sample_scales.repeat(repeats) * multipliers[index]
+
+        hidden = x.reshape(x.shape[0], -1, x.shape[-1]).to(A_all.dtype)
+        hidden = torch.bmm(hidden, A_all[index].transpose(1, 2)) * scales.view(-1, 1, 1).to(A_all.dtype)
+        delta = torch.bmm(hidden, B_all[index].transpose(1, 2))
+        return output + delta.view(output.shape).to(output.dtype)
@@ -10,19 +10,36 @@ Usage:
 """
 
 import argparse
+import gc
+import hashlib
+import itertools
+import json
 import math
 import os
+import re
+import shutil
+import time
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
 
+import numpy as np
 import torch
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, Sampler
 from accelerate import Accelerator
+from accelerate.utils import gather_object, set_seed
 from diffusers import ZImagePipeline, FlowMatchEulerDiscreteScheduler
 from peft import LoraConfig, get_peft_model
 from PIL import Image
-from safetensors.torch import save_file
+from safetensors.torch import load_file, save_file
 from tqdm import tqdm
 
+from zimage_lora import MergedLoRA, WeightSnapshot, merge_lora
+
+
+# Captions are truncated to this many tokens
+MAX_PROMPT_TOKENS = 512
 
 # Common aspect ratio buckets for training
 BUCKETS = [
@@ -44,6 +61,44 @@ def find_best_bucket(width: int, height: int) -> tuple[int, int]:
     return best_bucket
 
 
+def image_to_tensor(image: Image.Image) -> torch.Tensor:
+    """Convert an RGB PIL image to a [3, H, W] float tensor normalized to [-1, 1]."""
+    # Go through the image buffer so no per-pixel Python objects are created
+    pixels = torch.from_numpy(np.array(image))
+    return pixels.permute(2, 0, 1).float() / 127.5 - 1.0
+
+
+def load_image(img_path: Path) -> tuple[torch.Tensor, tuple[int, int]]:
+    """Load an image, resize it to its bucket and convert it to a normalized tensor."""
+    with Image.open(img_path) as image:
+        image = image.convert("RGB")
+    bucket_w, bucket_h = find_best_bucket(image.width, image.height)
+    image = image.resize((bucket_w, bucket_h), Image.LANCZOS)
+    return image_to_tensor(image), (bucket_w, bucket_h)
+
+
+def prefetch_images(img_paths: list[Path], num_workers: int = 4, use_processes: bool = False, prefetch: int = 16):
+    """
+    Yield load_image() results in order, decoding ahead on a worker pool.
+
+    PIL releases the GIL while decoding and resizing, so threads scale well;
+    processes avoid the GIL entirely at the cost of pickling each tensor back.
+    """
+    if num_workers <= 0:
+        yield from map(load_image, img_paths)
+        return
+
+    pool_cls = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    with pool_cls(max_workers=num_workers) as pool:
+        pending = deque()
+        for img_path in img_paths:
+            pending.append(pool.submit(load_image, img_path))
+            if len(pending) >= prefetch:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
 class ImageCaptionDataset(Dataset):
     """Simple dataset that loads images and their caption files."""
 
@@ -56,7 +111,8 @@ class ImageCaptionDataset(Dataset):
 
         # Find all images with matching caption files
         self.samples = []
-        for img_path in self.folder.glob("*"):
+        # Sorted so sample indices (and resumed data order) don't depend on the filesystem
+        for img_path in sorted(self.folder.glob("*")):
             if img_path.suffix.lower() in [".jpg", ".jpeg", ".png", ".webp"]:
                 caption_path = img_path.with_suffix(".txt")
                 if caption_path.exists():
@@ -70,17 +126,21 @@ class ImageCaptionDataset(Dataset):
     def __len__(self):
         return len(self.samples)
 
+    def get_bucket(self, idx) -> tuple[int, int]:
+        """Return the bucket for a sample, reading only the image header."""
+        img_path, _ = self.samples[idx]
+        with Image.open(img_path) as image:
+            return find_best_bucket(image.width, image.height)
+
+    def get_caption(self, idx) -> str:
+        _, caption_path = self.samples[idx]
+        return caption_path.read_text().strip()
+
     def __getitem__(self, idx):
         img_path, caption_path = self.samples[idx]
 
-        # Load and preprocess image
-        image = Image.open(img_path).convert("RGB")
-        bucket_w, bucket_h = find_best_bucket(image.width, image.height)
-        image = image.resize((bucket_w, bucket_h), Image.LANCZOS)
-
-        # Convert to tensor and normalize to [-1, 1]
-        img_tensor = torch.tensor(list(image.getdata()), dtype=torch.float32)
-        img_tensor = img_tensor.view(bucket_h, bucket_w, 3).permute(2, 0, 1) / 127.5 - 1.0
+        # Load, resize to bucket and normalize to [-1, 1]
+        img_tensor, bucket = load_image(img_path)
 
         # Load caption
         caption = caption_path.read_text().strip()
@@ -88,14 +148,274 @@ class ImageCaptionDataset(Dataset):
         return {
             "image": img_tensor,
             "caption": caption,
-            "bucket": (bucket_w, bucket_h),
+            "bucket": bucket,
         }
 
 
+class LatentCache:
+    """
+    Content-addressed on-disk cache of VAE latents and text embeddings.
+
+    Each sample is stored in its own safetensors file named by a hash of the
+    image bytes, caption, model id, bucket and VAE scaling factor. Re-runs on
+    the same data skip the encoders entirely, and new or edited samples simply
+    miss the cache and are encoded on their own.
+    """
+
+    # Bump when the layout of cached tensors changes
+    VERSION = 2
+
+    def __init__(self, cache_dir: str, model_id: str, scaling_factor: float):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.model_id = model_id
+        self.scaling_factor = scaling_factor
+
+    def key(self, img_path: Path, caption: str, bucket: tuple[int, int]) -> str:
+        """Compute the cache key for an image/caption pair."""
+        digest = hashlib.sha256()
+        digest.update(Path(img_path).read_bytes())
+        digest.update(json.dumps({
+            "caption": caption,
+            "model_id": self.model_id,
+            "bucket": list(bucket),
+            "scaling_factor": self.scaling_factor,
+            "version": self.VERSION,
+        }, sort_keys=True).encode())
+        return digest.hexdigest()
+
+    def path(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / f"{key}.safetensors"
+
+    def load(self, key: str, device) -> dict | None:
+        """Load a cached sample, or return None on a miss."""
+        path = self.path(key)
+        if not path.exists():
+            return None
+        try:
+            return load_file(path, device=str(device))
+        except Exception as e:
+            # Partially written or corrupt entry - re-encode it
+            print(f"Ignoring unreadable cache entry {path}: {e}")
+            return None
+
+    def save(self, key: str, tensors: dict[str, torch.Tensor]):
+        """Atomically write a sample to the cache."""
+        path = self.path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        save_file({name: t.detach().contiguous().cpu() for name, t in tensors.items()}, tmp_path)
+        os.replace(tmp_path, path)
+
+
+class SampleStore:
+    """
+    Holds cached training samples on the GPU, in host memory, or on disk.
+
+    "device" keeps every tensor in VRAM. "host" keeps them in pinned CPU memory
+    so batches can be copied to the GPU asynchronously. "disk" keeps only the
+    latent cache keys and memory-maps each sample's safetensors file when it is
+    batched, so dataset size is limited by disk rather than memory.
+    """
+
+    BACKENDS = ("device", "host", "disk")
+
+    def __init__(self, size: int, backend: str, device, latent_cache: LatentCache | None = None):
+        if backend not in self.BACKENDS:
+            raise ValueError(f"Unknown cache backend '{backend}', expected one of {self.BACKENDS}")
+        if backend == "disk" and latent_cache is None:
+            raise ValueError("The disk cache backend requires a latent cache directory")
+
+        self.backend = backend
+        self.device = device
+        self.latent_cache = latent_cache
+        self.pin = backend != "device" and torch.cuda.is_available()
+        self.samples = [None] * size
+        self.buckets = [None] * size
+
+    def __len__(self):
+        return len(self.samples)
+
+    def _store(self, tensor: torch.Tensor) -> torch.Tensor:
+        if self.backend == "device":
+            return tensor.to(self.device)
+        tensor = tensor.cpu()
+        return tensor.pin_memory() if self.pin else tensor
+
+    def has(self, idx: int) -> bool:
+        return self.samples[idx] is not None
+
+    def add(self, idx: int, entry: dict[str, torch.Tensor], bucket: tuple[int, int], cache_key: str | None = None):
+        """Store a freshly encoded sample (already saved to the latent cache for the disk backend)."""
+        self.buckets[idx] = bucket
+        if self.backend == "disk":
+            self.samples[idx] = cache_key
+        else:
+            self.samples[idx] = {name: self._store(t) for name, t in entry.items()}
+
+    def add_from_cache(self, idx: int, cache_key: str, bucket: tuple[int, int]) -> bool:
+        """Fill a slot from the latent cache, returning False on a miss."""
+        if self.backend == "disk":
+            if not self.latent_cache.path(cache_key).exists():
+                return False
+            self.samples[idx] = cache_key
+        else:
+            load_device = self.device if self.backend == "device" else "cpu"
+            entry = self.latent_cache.load(cache_key, load_device)
+            if entry is None:
+                return False
+            self.samples[idx] = {name: self._store(t) for name, t in entry.items()}
+        self.buckets[idx] = bucket
+        return True
+
+    def get(self, idx: int) -> dict[str, torch.Tensor]:
+        if self.backend == "disk":
+            return self.latent_cache.load(self.samples[idx], "cpu")
+        return self.samples[idx]
+
+    def get_batch(self, batch_indices: list[int]) -> tuple[torch.Tensor, list[torch.Tensor]]:
+        """Stack latents for a batch; prompt embeddings keep their own lengths."""
+        samples = [self.get(i) for i in batch_indices]
+        latents = torch.stack([sample["latent"] for sample in samples])
+        prompt_embeds = [sample["prompt_embeds"] for sample in samples]
+        if self.pin:
+            latents = latents.pin_memory()
+            prompt_embeds = [e if e.is_pinned() else e.pin_memory() for e in prompt_embeds]
+        return latents, prompt_embeds
+
+
+class BatchPrefetcher:
+    """
+    Loads upcoming batches on a background thread and copies them to the GPU on
+    a side CUDA stream, so data movement overlaps the current training step.
+    """
+
+    def __init__(self, load_batch, device, dtype: torch.dtype, depth: int = 2):
+        self.load_batch = load_batch
+        self.device = torch.device(device)
+        self.dtype = dtype
+        self.depth = depth
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == "cuda" else None
+
+    def _load(self, batch_indices: list[int]):
+        latents, prompt_embeds = self.load_batch(batch_indices)
+        if self.stream is None:
+            latents = latents.to(self.device, dtype=self.dtype)
+            prompt_embeds = [e.to(self.device, dtype=self.dtype) for e in prompt_embeds]
+            return latents, prompt_embeds, None
+
+        with torch.cuda.stream(self.stream):
+            latents = latents.to(self.device, dtype=self.dtype, non_blocking=True)
+            prompt_embeds = [e.to(self.device, dtype=self.dtype, non_blocking=True) for e in prompt_embeds]
+            ready = torch.cuda.Event()
+            ready.record(self.stream)
+        return latents, prompt_embeds, ready
+
+    def _wait(self, loaded):
+        latents, prompt_embeds, ready = loaded
+        if ready is not None:
+            stream = torch.cuda.current_stream(self.device)
+            stream.wait_event(ready)
+            # Tensors were allocated on the side stream but are used on this one
+            for tensor in [latents, *prompt_embeds]:
+                tensor.record_stream(stream)
+        return latents, prompt_embeds
+
+    def __call__(self, batches):
+        """Yield (latents, prompt_embeds) on device for each list of sample indices."""
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            pending = deque()
+            for batch_indices in batches:
+                pending.append(pool.submit(self._load, batch_indices))
+                if len(pending) >= self.depth:
+                    yield self._wait(pending.popleft().result())
+            while pending:
+                yield self._wait(pending.popleft().result())
+
+
+class BucketBatchSampler(Sampler):
+    """
+    Batch sampler that only groups samples from the same aspect ratio bucket.
+
+    Indices are shuffled within each bucket and the resulting batches are
+    shuffled across buckets, reseeded every epoch via set_epoch(). Leftover
+    samples form a smaller final batch for their bucket unless drop_last is set.
+    With multiple processes each rank gets a disjoint slice of the batches.
+    """
+
+    def __init__(
+        self,
+        buckets: list[tuple[int, int]],
+        batch_size: int,
+        shuffle: bool = True,
+        drop_last: bool = False,
+        seed: int = 0,
+        num_replicas: int = 1,
+        rank: int = 0,
+    ):
+        self.buckets = list(buckets)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+
+        # Group sample indices by bucket (sorted for a stable order across ranks)
+        self.bucket_indices = {}
+        for idx, bucket in enumerate(self.buckets):
+            self.bucket_indices.setdefault(bucket, []).append(idx)
+        self.bucket_indices = dict(sorted(self.bucket_indices.items()))
+
+    def set_epoch(self, epoch: int):
+        """Set the epoch used to seed shuffling, so every epoch gets a new order."""
+        self.epoch = epoch
+
+    def _num_batches(self) -> int:
+        total = 0
+        for indices in self.bucket_indices.values():
+            if self.drop_last:
+                total += len(indices) // self.batch_size
+            else:
+                total += math.ceil(len(indices) / self.batch_size)
+        return total
+
+    def __len__(self):
+        return math.ceil(self._num_batches() / self.num_replicas)
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+
+        batches = []
+        for indices in self.bucket_indices.values():
+            if self.shuffle:
+                order = torch.randperm(len(indices), generator=generator).tolist()
+                indices = [indices[i] for i in order]
+            for start in range(0, len(indices), self.batch_size):
+                batch = indices[start:start + self.batch_size]
+                if len(batch) < self.batch_size and self.drop_last:
+                    continue
+                batches.append(batch)
+
+        if self.shuffle:
+            order = torch.randperm(len(batches), generator=generator).tolist()
+            batches = [batches[i] for i in order]
+
+        # Pad with repeated batches so every rank gets the same number of batches
+        if batches and len(batches) % self.num_replicas:
+            padding = self.num_replicas - len(batches) % self.num_replicas
+            batches += (batches * math.ceil(padding / len(batches)))[:padding]
+
+        yield from batches[self.rank::self.num_replicas]
+
+
 def collate_fn(batch):
-    """Collate function that groups by bucket size."""
-    # For simplicity, just use the first item's bucket
-    # A more sophisticated version would batch by bucket
+    """Collate function for batches that share a single bucket size."""
+    buckets = {item["bucket"] for item in batch}
+    if len(buckets) > 1:
+        raise ValueError(f"Batch mixes bucket sizes {sorted(buckets)}; use BucketBatchSampler")
     return {
         "images": torch.stack([item["image"] for item in batch]),
         "captions": [item["caption"] for item in batch],
@@ -103,12 +423,20 @@ def collate_fn(batch):
     }
 
 
-def encode_prompt(tokenizer, text_encoder, prompt: str, device: str) -> torch.Tensor:
-    """Encode a text prompt to embeddings."""
+def encode_prompts(
+    tokenizer, text_encoder, prompts: list[str], device: str, max_length: int = MAX_PROMPT_TOKENS
+) -> list[torch.Tensor]:
+    """
+    Encode a batch of text prompts to embeddings.
+
+    Prompts are padded only to the longest prompt in the batch, and padding
+    positions are stripped from the output, so each returned tensor is
+    [num_tokens, hidden] with num_tokens being the prompt's true length.
+    """
     inputs = tokenizer(
-        prompt,
-        padding="max_length",
-        max_length=512,
+        prompts,
+        padding="longest",
+        max_length=max_length,
         truncation=True,
         return_tensors="pt",
     )
@@ -120,87 +448,411 @@ def encode_prompt(tokenizer, text_encoder, prompt: str, device: str) -> torch.Te
         # Use the last hidden state
         prompt_embeds = outputs.last_hidden_state
 
-    return prompt_embeds, attention_mask
+    # Drop padding positions (works for both left and right padding)
+    mask = attention_mask.bool()
+    return [prompt_embeds[i][mask[i]] for i in range(len(prompts))]
 
 
-def load_training_adapter(transformer, adapter_path: str, device: str, dtype: torch.dtype):
+def encode_images(vae, images: torch.Tensor, batch_size: int) -> tuple[torch.Tensor, int]:
     """
-    Load and merge the de-distillation training adapter.
-    This "de-distills" the model for stable training.
-    Returns state needed to remove the adapter later.
-    """
-    from safetensors.torch import load_file
+    Encode a stack of same-sized images to scaled latents in chunks.
 
-    print(f"Loading training adapter from {adapter_path}")
-    state_dict = load_file(adapter_path)
-
-    # Get LoRA rank
-    lora_rank = None
-    for key, value in state_dict.items():
-        if "lora_A" in key or "lora_down" in key:
-            lora_rank = value.shape[0]
-            break
-
-    if lora_rank is None:
-        raise ValueError("Could not determine adapter rank")
-
-    # Group lora_A and lora_B pairs
-    lora_pairs = {}
-    for key, value in state_dict.items():
-        base_key = key.replace("diffusion_model.", "")
-
-        if ".lora_A." in base_key or ".lora_down." in base_key:
-            if ".lora_A." in base_key:
-                module_path = base_key.split(".lora_A.")[0]
-            else:
-                module_path = base_key.split(".lora_down.")[0]
-            if module_path not in lora_pairs:
-                lora_pairs[module_path] = {}
-            lora_pairs[module_path]["A"] = value
-        elif ".lora_B." in base_key or ".lora_up." in base_key:
-            if ".lora_B." in base_key:
-                module_path = base_key.split(".lora_B.")[0]
-            else:
-                module_path = base_key.split(".lora_up.")[0]
-            if module_path not in lora_pairs:
-                lora_pairs[module_path] = {}
-            lora_pairs[module_path]["B"] = value
-
-    # Merge adapter into weights: W' = W + (B @ A)
-    # Track (module, delta) for removal later
-    merged_count = 0
-    adapter_state = []
-    for module_path, pair in lora_pairs.items():
-        if "A" not in pair or "B" not in pair:
+    A chunk that runs out of GPU memory is retried at half the size, down to
+    one image at a time. Returns the latents and the batch size that worked.
+    """
+    latents = []
+    start = 0
+    while start < len(images):
+        chunk = images[start:start + batch_size]
+        try:
+            latent = vae.encode(chunk).latent_dist.sample()
+        except torch.cuda.OutOfMemoryError:
+            if batch_size == 1:
+                raise
+            batch_size = max(1, batch_size // 2)
+            torch.cuda.empty_cache()
+            print(f"VAE encode ran out of memory, retrying with batch size {batch_size}")
             continue
+        latents.append(latent * vae.config.scaling_factor)
+        start += len(chunk)
+    return torch.cat(latents), batch_size
 
-        parts = module_path.split(".")
-        module = transformer
-        for part in parts:
-            if part.isdigit():
-                module = module[int(part)]
-            else:
-                module = getattr(module, part)
 
-        if not hasattr(module, "weight"):
-            continue
+def grad_norm(parameters) -> torch.Tensor:
+    """Total L2 norm of the gradients, computed on device without a sync."""
+    grads = [p.grad.detach() for p in parameters if p.grad is not None]
+    if not grads:
+        return torch.zeros(())
+    return torch.linalg.vector_norm(torch.stack(torch._foreach_norm(grads)))
 
-        lora_A = pair["A"].to(device, dtype=dtype)
-        lora_B = pair["B"].to(device, dtype=dtype)
-        delta = lora_B @ lora_A
-        module.weight.data += delta
-        adapter_state.append((module, delta))
-        merged_count += 1
 
-    print(f"Merged training adapter into {merged_count} layers")
+class TrainingMetrics:
+    """
+    Collects training metrics without forcing a GPU sync every step.
+
+    Loss and grad norm are written into preallocated device buffers; timings,
+    learning rate and memory are read on the host. Every `log_every` optimizer
+    steps the buffers are pulled to the host in one transfer, printed, and
+    appended to a JSONL file. Disabled instances (non-main processes) do nothing.
+    """
+
+    def __init__(
+        self,
+        device,
+        log_every: int = 10,
+        jsonl_path: str | None = None,
+        samples_per_step: int = 1,
+        enabled: bool = True,
+    ):
+        self.device = torch.device(device)
+        self.log_every = log_every
+        self.jsonl_path = Path(jsonl_path) if jsonl_path else None
+        self.samples_per_step = samples_per_step
+        self.enabled = enabled
+
+        self.losses = torch.zeros(log_every, device=self.device)
+        self.grad_norms = torch.zeros(log_every, device=self.device)
+        self.micro_batches = 0
+        self.count = 0
+        self.lrs = []
+        self.window_start = time.perf_counter()
+
+        if self.enabled and self.jsonl_path:
+            self.jsonl_path.parent.mkdir(parents=True, exist_ok=True)
+
+    def add_loss(self, loss: torch.Tensor):
+        """Accumulate the loss of one micro-batch into the current step."""
+        if not self.enabled:
+            return
+        self.losses[self.count] += loss.detach().float()
+        self.micro_batches += 1
+
+    def step(self, global_step: int, lr: float, norm: torch.Tensor | None = None) -> dict | None:
+        """Close the current optimizer step; returns the flushed record every log_every steps."""
+        if not self.enabled:
+            return None
+        if self.micro_batches > 1:
+            self.losses[self.count] /= self.micro_batches
+        if norm is not None:
+            self.grad_norms[self.count] = norm.float()
+        self.lrs.append(lr)
+        self.micro_batches = 0
+        self.count += 1
+        if self.count == self.log_every:
+            return self.flush(global_step)
+        return None
+
+    def flush(self, global_step: int) -> dict | None:
+        if not self.enabled or self.count == 0:
+            return None
+
+        # One device-to-host transfer for the whole window
+        values = torch.stack([self.losses[:self.count], self.grad_norms[:self.count]]).tolist()
+        elapsed = time.perf_counter() - self.window_start
+
+        record = {
+            "step": global_step,
+            "loss": sum(values[0]) / self.count,
+            "grad_norm": sum(values[1]) / self.count,
+            "lr": self.lrs[-1],
+            "step_time": elapsed / self.count,
+            "samples_per_sec": self.samples_per_step * self.count / elapsed,
+        }
+        if self.device.type == "cuda":
+            record["peak_memory_gb"] = torch.cuda.max_memory_allocated(self.device) / 1024**3
+            torch.cuda.reset_peak_memory_stats(self.device)
+
+        tqdm.write(
+            f"step {record['step']}: loss={record['loss']:.4f} grad_norm={record['grad_norm']:.3f} "
+            f"lr={record['lr']:.2e} {record['step_time']:.3f}s/step {record['samples_per_sec']:.2f} samples/s"
+            + (f" peak_mem={record['peak_memory_gb']:.1f}GB" if "peak_memory_gb" in record else "")
+        )
+        if self.jsonl_path:
+            with open(self.jsonl_path, "a") as f:
+                f.write(json.dumps(record) + "\n")
+
+        self.losses.zero_()
+        self.grad_norms.zero_()
+        self.lrs = []
+        self.count = 0
+        self.window_start = time.perf_counter()
+        return record
+
+
+class StepProfiler:
+    """
+    Times each phase of the training step over a window of micro-steps.
+
+    Wall time is measured on the host with the device synchronized at every
+    phase boundary, and device time with CUDA events, so this slows training
+    down and is only meant for --profile runs. After the window a table of
+    per-phase percentiles is printed. Optionally the first few profiled steps
+    are also captured with torch.profiler and exported as a Chrome trace.
+    """
+
+    PHASES = ("data", "noise", "forward", "backward", "optimizer")
+
+    def __init__(
+        self,
+        device,
+        warmup: int = 5,
+        steps: int = 20,
+        trace_path: str | None = None,
+        trace_steps: int = 3,
+        enabled: bool = True,
+    ):
+        self.device = torch.device(device)
+        self.warmup = warmup
+        self.steps = steps
+        self.trace_path = trace_path
+        self.trace_steps = trace_steps
+        self.enabled = enabled
+
+        self.use_events = self.device.type == "cuda"
+        self.step_index = 0
+        self.step_end_time = None
+        self.wall = {name: [] for name in self.PHASES}
+        self.events = {name: [] for name in self.PHASES}
+        self.trace = None
+
+    @property
+    def active(self) -> bool:
+        return self.enabled and self.warmup <= self.step_index < self.warmup + self.steps
+
+    def _sync(self):
+        if self.use_events:
+            torch.cuda.synchronize(self.device)
+
+    def start_step(self):
+        """Mark the start of a micro-step; time since the last step counts as data loading."""
+        if not self.active:
+            return
+        if self.step_index == self.warmup and self.trace_path:
+            self.trace = torch.profiler.profile(
+                activities=[torch.profiler.ProfilerActivity.CPU, torch.profiler.ProfilerActivity.CUDA],
+                record_shapes=True,
+            )
+            self.trace.start()
+        if self.step_end_time is not None:
+            self.wall["data"].append(time.perf_counter() - self.step_end_time)
+
+    @contextmanager
+    def phase(self, name: str):
+        """Time a block of work as one phase of the current step."""
+        if not self.active:
+            yield
+            return
+
+        with torch.profiler.record_function(name):
+            self._sync()
+            start = time.perf_counter()
+            if self.use_events:
+                start_event = torch.cuda.Event(enable_timing=True)
+                end_event = torch.cuda.Event(enable_timing=True)
+                start_event.record()
+            yield
+            if self.use_events:
+                end_event.record()
+                self.events[name].append((start_event, end_event))
+            self._sync()
+            self.wall[name].append(time.perf_counter() - start)
+
+    def end_step(self):
+        if not self.enabled:
+            return
+        was_active = self.active
+        self.step_index += 1
+        self.step_end_time = time.perf_counter()
+
+        if self.trace is not None and self.step_index == self.warmup + self.trace_steps:
+            self.trace.stop()
+            self.trace.export_chrome_trace(self.trace_path)
+            print(f"Exported Chrome trace to {self.trace_path}")
+            self.trace = None
+        if was_active and not self.active:
+            self.report()
+
+    def report(self):
+        def percentile(values, q):
+            ordered = sorted(values)
+            return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+        print(f"\nStep profile over {self.steps} micro-steps (ms):")
+        print(f"  {'phase':<10} {'wall p50':>9} {'wall p90':>9} {'wall p99':>9} {'device p50':>11} {'device p90':>11}")
+        for name in self.PHASES:
+            wall = [t * 1000 for t in self.wall[name]]
+            device = [start.elapsed_time(end) for start, end in self.events[name]]
+            if not wall:
+                continue
+            line = f"  {name:<10} {percentile(wall, 50):9.2f} {percentile(wall, 90):9.2f} {percentile(wall, 99):9.2f}"
+            if device:
+                line += f" {percentile(device, 50):11.2f} {percentile(device, 90):11.2f}"
+            print(line)
+
+
+class CPUOffloadAdamW:
+    """
+    AdamW that keeps its state and an fp32 master copy of each parameter in
+    pinned host memory, so optimizer state never occupies VRAM.
+
+    Each step copies the gradients down, runs the update on the CPU and copies
+    the parameters back. Not wrapped by accelerate, so the caller only steps it
+    on gradient-sync boundaries.
+    """
+
+    def __init__(self, param_groups: list[dict], **kwargs):
+        pin = torch.cuda.is_available()
+        self.pairs = []
+        host_groups = []
+        for group in param_groups:
+            host_params = []
+            for param in group["params"]:
+                host_param = param.detach().to("cpu", dtype=torch.float32, copy=True)
+                if pin:
+                    host_param = host_param.pin_memory()
+                host_param.grad = torch.zeros_like(host_param)
+                self.pairs.append((param, host_param))
+                host_params.append(host_param)
+            host_groups.append({**group, "params": host_params})
+        self.optimizer = torch.optim.AdamW(host_groups, foreach=True, **kwargs)
+
+    @property
+    def param_groups(self):
+        return self.optimizer.param_groups
+
+    def step(self):
+        for param, host_param in self.pairs:
+            if param.grad is not None:
+                host_param.grad.copy_(param.grad, non_blocking=True)
+            else:
+                host_param.grad.zero_()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+
+        self.optimizer.step()
+
+        with torch.no_grad():
+            for param, host_param in self.pairs:
+                param.copy_(host_param, non_blocking=True)
+
+    def zero_grad(self, set_to_none: bool = True):
+        for param, _ in self.pairs:
+            if set_to_none:
+                param.grad = None
+            elif param.grad is not None:
+                param.grad.zero_()
+
+    def state_dict(self) -> dict:
+        return self.optimizer.state_dict()
+
+    def load_state_dict(self, state_dict: dict):
+        self.optimizer.load_state_dict(state_dict)
+        # Parameters may have been restored since the master copies were made
+        with torch.no_grad():
+            for param, host_param in self.pairs:
+                host_param.copy_(param.detach())
+
+
+def build_optimizer(
+    model,
+    lr: float,
+    weight_decay: float = 0.01,
+    impl: str = "fused",
+    offload: bool = False,
+):
+    """
+    Create AdamW over the trainable (LoRA) parameters only.
+
+    Matrices get weight decay; biases and other 1-D parameters do not. `impl`
+    selects the PyTorch AdamW kernel ("default", "foreach" or "fused"), and
+    `offload` keeps the optimizer state in host memory instead.
+    """
+    decay, no_decay = [], []
+    for param in model.parameters():
+        if not param.requires_grad:
+            continue
+        (decay if param.ndim >= 2 else no_decay).append(param)
+
+    param_groups = [{"params": decay, "weight_decay": weight_decay}]
+    if no_decay:
+        param_groups.append({"params": no_decay, "weight_decay": 0.0})
+
+    if offload:
+        return CPUOffloadAdamW(param_groups, lr=lr)
+
+    kwargs = {}
+    if impl == "fused":
+        if all(p.is_cuda for group in param_groups for p in group["params"]):
+            kwargs["fused"] = True
+        else:
+            kwargs["foreach"] = True
+    elif impl == "foreach":
+        kwargs["foreach"] = True
+    elif impl != "default":
+        raise ValueError(f"Unknown optimizer implementation '{impl}'")
+    return torch.optim.AdamW(param_groups, lr=lr, **kwargs)
+
+
+def compute_loss(transformer, latents: torch.Tensor, prompt_embeds: list[torch.Tensor], profiler=None):
+    """Flow matching loss for one batch of cached latents and prompt embeddings."""
+    phase = profiler.phase if profiler else (lambda name: nullcontext())
+
+    with phase("noise"):
+        # Sample noise and timesteps for flow matching
+        noise = torch.randn_like(latents)
+        # Sample timesteps in [0, 1000] range, then convert for model
+        timesteps = torch.randint(0, 1000, (latents.shape[0],), device=latents.device)
+
+        # Flow matching forward: x_t = (1 - t) * x_0 + t * noise
+        t_normalized = timesteps.float() / 1000.0
+        t_expanded = t_normalized.view(-1, 1, 1, 1)
+        noisy_latents = (1 - t_expanded) * latents + t_expanded * noise
+
+        # Z-Image expects [B, C, F, H, W] with frames dimension
+        noisy_latents = noisy_latents.unsqueeze(2)  # Add frames dim
+        # Convert to list of tensors (one per batch item)
+        latent_list = list(noisy_latents.unbind(dim=0))
+
+        # Timestep format for Z-Image: (1000 - t) / 1000
+        timestep_model_input = (1000 - timesteps.float()) / 1000.0
+
+    with phase("forward"):
+        # Predict velocity using Z-Image API
+        model_out_list = transformer(
+            latent_list,
+            timestep_model_input,
+            prompt_embeds,
+        )[0]
+
+        # Process output: stack, squeeze frames dim, negate
+        model_pred = torch.stack([t.float() for t in model_out_list], dim=0)
+        model_pred = model_pred.squeeze(2)  # Remove frames dim
+        model_pred = -model_pred  # Z-Image outputs need negation
+
+        # Flow matching target: velocity = noise - x_0
+        target = (noise - latents).float()
+        loss = torch.nn.functional.mse_loss(model_pred, target)
+
+    return loss
+
+
+def load_training_adapter(transformer, adapter_path: str, device: str, dtype: torch.dtype) -> MergedLoRA:
+    """
+    Load and merge the de-distillation training adapter.
+    This "de-distills" the model for stable training.
+    Returns state needed to remove the adapter later.
+    """
+    print(f"Loading training adapter from {adapter_path}")
+    # Snapshot the touched weights so removal restores them exactly
+    adapter_state = merge_lora(transformer, adapter_path, device=device, dtype=dtype, snapshot=WeightSnapshot())
+    print(f"Merged training adapter into {adapter_state.num_layers} layers")
     return adapter_state
 
 
-def remove_training_adapter(adapter_state):
-    """Remove the training adapter by subtracting the deltas."""
-    for module, delta in adapter_state:
-        module.weight.data -= delta
-    print(f"Removed training adapter from {len(adapter_state)} layers")
+def remove_training_adapter(adapter_state: MergedLoRA):
+    """Remove the training adapter by restoring the snapshotted weights."""
+    adapter_state.unmerge()
+    print(f"Removed training adapter from {adapter_state.num_layers} layers")
 
 
 def save_lora_weights(model, output_path: str):
@@ -220,6 +872,181 @@ def save_lora_weights(model, output_path: str):
     print(f"Saved LoRA weights to {output_path}")
 
 
+def find_max_batch_size(
+    transformer,
+    latent: torch.Tensor,
+    prompt_embeds: torch.Tensor,
+    max_batch_size: int = 64,
+    memory_budget: float = 0.9,
+    reserved_bytes: int = 0,
+) -> int:
+    """
+    Find the largest micro-batch whose forward/backward fits in GPU memory.
+
+    Probes with copies of the given latent and prompt embedding (use the largest
+    bucket and longest prompt), doubling until a probe runs out of memory or
+    exceeds `memory_budget` of the device, then binary-searching the gap.
+    `reserved_bytes` accounts for memory the probe does not allocate, such as
+    optimizer state.
+    """
+    device = latent.device
+    budget = torch.cuda.get_device_properties(device).total_memory * memory_budget
+
+    def fits(batch_size: int) -> bool:
+        gc.collect()
+        torch.cuda.empty_cache()
+        torch.cuda.reset_peak_memory_stats(device)
+        try:
+            latents = latent.unsqueeze(0).expand(batch_size, *latent.shape).contiguous()
+            loss = compute_loss(transformer, latents, [prompt_embeds] * batch_size)
+            loss.backward()
+            peak = torch.cuda.max_memory_allocated(device) + reserved_bytes
+        except torch.cuda.OutOfMemoryError:
+            return False
+        finally:
+            transformer.zero_grad(set_to_none=True)
+        return peak <= budget
+
+    transformer.train()
+    largest_fit, candidate = 0, 1
+    while candidate <= max_batch_size and fits(candidate):
+        largest_fit, candidate = candidate, candidate * 2
+
+    # Binary search between the last size that fit and the first that did not
+    low, high = largest_fit + 1, min(candidate, max_batch_size + 1) - 1
+    while low <= high:
+        mid = (low + high) // 2
+        if fits(mid):
+            largest_fit, low = mid, mid + 1
+        else:
+            high = mid - 1
+
+    gc.collect()
+    torch.cuda.empty_cache()
+    if largest_fit == 0:
+        raise RuntimeError("A batch of one sample does not fit in GPU memory")
+    return largest_fit
+
+
+def find_latest_checkpoint(checkpoint_dir: str) -> Path | None:
+    """Return the most recent complete checkpoint in a directory, if any."""
+    checkpoint_dir = Path(checkpoint_dir)
+    if not checkpoint_dir.exists():
+        return None
+    checkpoints = [p for p in checkpoint_dir.iterdir() if p.is_dir() and re.fullmatch(r"step_\d+", p.name)]
+    return max(checkpoints, key=lambda p: int(p.name.split("_")[1]), default=None)
+
+
+def save_checkpoint(
+    accelerator,
+    transformer,
+    optimizer,
+    checkpoint_dir: str,
+    global_step: int,
+    epoch: int,
+    batch_position: int,
+    run_config: dict,
+    keep: int = 2,
+):
+    """
+    Save everything needed to resume training exactly where it stopped.
+
+    Writes the LoRA parameters, optimizer state, per-process RNG states, the
+    data-order position (epoch and batches consumed in it) and the run_config
+    that gives that position its meaning (batch size, accumulation, seed and
+    dataset fingerprint) into a temporary directory, then renames it so a
+    checkpoint is never seen half-written.
+    """
+    checkpoint_dir = Path(checkpoint_dir)
+    final_dir = checkpoint_dir / f"step_{global_step:07d}"
+    tmp_dir = checkpoint_dir / f"step_{global_step:07d}.tmp"
+
+    if accelerator.is_main_process:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        tmp_dir.mkdir(parents=True)
+    accelerator.wait_for_everyone()
+
+    rng_state = {"cpu": torch.get_rng_state()}
+    if torch.cuda.is_available():
+        rng_state["cuda"] = torch.cuda.get_rng_state(accelerator.device)
+    torch.save(rng_state, tmp_dir / f"rng_{accelerator.process_index}.pt")
+
+    if accelerator.is_main_process:
+        unwrapped = accelerator.unwrap_model(transformer)
+        lora_state = {
+            name: param.detach().cpu().contiguous()
+            for name, param in unwrapped.named_parameters()
+            if param.requires_grad
+        }
+        save_file(lora_state, tmp_dir / "lora.safetensors")
+        torch.save(optimizer.state_dict(), tmp_dir / "optimizer.pt")
+        (tmp_dir / "state.json").write_text(json.dumps({
+            "global_step": global_step,
+            "epoch": epoch,
+            "batch_position": batch_position,
+            "num_processes": accelerator.num_processes,
+            **run_config,
+        }, indent=2))
+    accelerator.wait_for_everyone()
+
+    if accelerator.is_main_process:
+        shutil.rmtree(final_dir, ignore_errors=True)
+        os.replace(tmp_dir, final_dir)
+
+        # Keep only the most recent checkpoints
+        checkpoints = sorted(
+            (p for p in checkpoint_dir.iterdir() if p.is_dir() and re.fullmatch(r"step_\d+", p.name)),
+            key=lambda p: int(p.name.split("_")[1]),
+        )
+        for old in checkpoints[:-keep] if keep > 0 else []:
+            shutil.rmtree(old, ignore_errors=True)
+        print(f"Saved checkpoint to {final_dir}")
+    accelerator.wait_for_everyone()
+
+
+def read_checkpoint_state(checkpoint_path: Path) -> dict:
+    return json.loads((Path(checkpoint_path) / "state.json").read_text())
+
+
+def check_resume_config(state: dict, run_config: dict):
+    """Raise if the run differs from the checkpoint in anything that changes the data order."""
+    mismatches = [
+        f"{key}: checkpoint {state[key]!r}, now {value!r}"
+        for key, value in run_config.items()
+        if key in state and state[key] != value
+    ]
+    if mismatches:
+        raise ValueError("Cannot resume, the run no longer matches the checkpoint: " + "; ".join(mismatches))
+
+
+def load_checkpoint(accelerator, transformer, optimizer, checkpoint_path: Path) -> dict:
+    """Restore LoRA parameters, optimizer and RNG state; returns the saved loop position."""
+    state = read_checkpoint_state(checkpoint_path)
+    if state["num_processes"] != accelerator.num_processes:
+        raise ValueError(
+            f"Checkpoint was written with {state['num_processes']} processes, "
+            f"but {accelerator.num_processes} are running"
+        )
+
+    unwrapped = accelerator.unwrap_model(transformer)
+    lora_state = load_file(checkpoint_path / "lora.safetensors")
+    with torch.no_grad():
+        for name, param in unwrapped.named_parameters():
+            if param.requires_grad:
+                param.copy_(lora_state[name])
+
+    optimizer.load_state_dict(torch.load(checkpoint_path / "optimizer.pt", map_location="cpu"))
+
+    rng_state = torch.load(checkpoint_path / f"rng_{accelerator.process_index}.pt")
+    torch.set_rng_state(rng_state["cpu"])
+    if "cuda" in rng_state:
+        torch.cuda.set_rng_state(rng_state["cuda"], accelerator.device)
+
+    if accelerator.is_main_process:
+        print(f"Resumed from {checkpoint_path} at step {state['global_step']}")
+    return state
+
+
 def train(
     dataset_path: str,
     output_path: str,
@@ -230,18 +1057,48 @@ def train(
     lr: float = 1e-4,
     lora_rank: int = 32,
     cache_dir: str = None,
+    seed: int = 0,
+    latent_cache_dir: str = None,
+    text_batch_size: int = 16,
+    vae_batch_size: int = 8,
+    decode_workers: int = 4,
+    decode_processes: bool = False,
+    cache_backend: str = "host",
+    grad_accum: int = 1,
+    gradient_checkpointing: bool = False,
+    log_every: int = 10,
+    metrics_path: str = None,
+    checkpoint_every: int = 0,
+    checkpoint_dir: str = None,
+    keep_checkpoints: int = 2,
+    resume: bool = False,
+    profile: bool = False,
+    profile_warmup: int = 5,
+    profile_steps: int = 20,
+    profile_trace: str = None,
+    weight_decay: float = 0.01,
+    optimizer_impl: str = "fused",
+    optimizer_offload: bool = False,
+    auto_batch_size: bool = False,
+    target_batch_size: int = None,
+    max_auto_batch_size: int = 64,
+    memory_budget: float = 0.9,
 ):
     """Main training function with accelerate for multi-GPU support."""
 
     # Initialize accelerator for distributed training
     accelerator = Accelerator(
-        gradient_accumulation_steps=1,
+        gradient_accumulation_steps=grad_accum,
         mixed_precision="bf16",
     )
 
     device = accelerator.device
     dtype = torch.bfloat16
 
+    # Seed every process so latent sampling, noise and timesteps are reproducible
+    set_seed(seed, device_specific=True)
+    checkpoint_dir = checkpoint_dir or str(Path(output_path).with_suffix("")) + "_checkpoints"
+
     # Only print on main process
     if accelerator.is_main_process:
         print(f"Training Z-Image-Turbo LoRA")
@@ -249,6 +1106,8 @@ def train(
         print(f"  Output: {output_path}")
         print(f"  Steps: {steps}")
         print(f"  Batch size: {batch_size}")
+        print(f"  Gradient accumulation: {grad_accum}")
+        print(f"  Effective batch size: {batch_size * grad_accum * accelerator.num_processes}")
         print(f"  Learning rate: {lr}")
         print(f"  LoRA rank: {lora_rank}")
         print(f"  Devices: {accelerator.num_processes}")
@@ -279,6 +1138,10 @@ def train(
     text_encoder.requires_grad_(False)
 
 
+    # Trade compute for memory by recomputing activations in the backward pass
+    if gradient_checkpointing:
+        transformer.enable_gradient_checkpointing()
+
     # Load training adapter if provided (de-distills the model)
     adapter_state = None
     if adapter_path:
@@ -308,120 +1171,305 @@ def train(
         device=device,
     )
 
+    # Identifies the ordered sample list that checkpointed data positions refer to
+    dataset_fingerprint = hashlib.sha256(
+        "\n".join(img_path.name for img_path, _ in dataset.samples).encode()
+    ).hexdigest()
+
+    # A resumed run must see the same data order as the one that wrote the checkpoint
+    resume_state = None
+    if resume:
+        latest = find_latest_checkpoint(checkpoint_dir)
+        if latest is not None:
+            resume_state = read_checkpoint_state(latest)
+            check_resume_config(resume_state, {"seed": seed, "dataset_fingerprint": dataset_fingerprint})
+        elif accelerator.is_main_process:
+            print(f"No checkpoint found in {checkpoint_dir}, starting from scratch")
+
     # Pre-compute and cache all latents and text embeddings
     if accelerator.is_main_process:
         print("Caching latents and text embeddings...")
 
-    cached_samples = []
-    with torch.no_grad():
-        for idx in tqdm(range(len(dataset)), desc="Caching", disable=not accelerator.is_main_process):
-            sample = dataset[idx]
-            img_tensor = sample["image"].unsqueeze(0).to(device, dtype=dtype)
-
-            # Encode image to latent
-            latent = vae.encode(img_tensor).latent_dist.sample()
-            latent = latent.squeeze(0) * vae.config.scaling_factor
+    latent_cache = None
+    if latent_cache_dir:
+        latent_cache = LatentCache(latent_cache_dir, model_id, vae.config.scaling_factor)
+
+    # Each process encodes only its own slice of the dataset
+    rank = accelerator.process_index
+    num_processes = accelerator.num_processes
+    local_indices = list(range(rank, len(dataset), num_processes))
+
+    store = SampleStore(len(dataset), cache_backend, device, latent_cache)
+    cache_keys = {}
+    missing = []
+    for idx in local_indices:
+        # Reuse latents and embeddings from previous runs when available
+        if latent_cache:
+            bucket = dataset.get_bucket(idx)
+            cache_keys[idx] = latent_cache.key(dataset.samples[idx][0], dataset.get_caption(idx), bucket)
+            if store.add_from_cache(idx, cache_keys[idx], bucket):
+                continue
+        missing.append(idx)
+    num_cache_hits = len(local_indices) - len(missing)
 
-            # Encode text
-            prompt_embeds, attention_mask = encode_prompt(
-                tokenizer, text_encoder, sample["caption"], device
-            )
-
-            cached_samples.append({
-                "latent": latent,
-                "prompt_embeds": prompt_embeds.squeeze(0),
-                "attention_mask": attention_mask.squeeze(0),
-            })
+    with torch.no_grad():
+        # Encode captions in batches, sorted by length to keep padding small
+        captions = {idx: dataset.get_caption(idx) for idx in missing}
+        by_length = sorted(missing, key=lambda idx: len(captions[idx]))
+        prompt_embeds = {}
+        for start in tqdm(
+            range(0, len(by_length), text_batch_size),
+            desc="Encoding captions",
+            disable=not accelerator.is_main_process,
+        ):
+            chunk = by_length[start:start + text_batch_size]
+            embeds = encode_prompts(tokenizer, text_encoder, [captions[idx] for idx in chunk], device)
+            prompt_embeds.update(zip(chunk, embeds))
+
+        # Encode images in batches that share a bucket so they can be stacked
+        by_bucket = {}
+        for idx in missing:
+            by_bucket.setdefault(dataset.get_bucket(idx), []).append(idx)
+        image_batches = [
+            indices[start:start + vae_batch_size]
+            for indices in by_bucket.values()
+            for start in range(0, len(indices), vae_batch_size)
+        ]
+
+        # Decode and resize upcoming images on a worker pool while the VAE runs
+        loaded_images = prefetch_images(
+            [dataset.samples[idx][0] for batch in image_batches for idx in batch],
+            num_workers=decode_workers,
+            use_processes=decode_processes,
+        )
+
+        progress = tqdm(total=len(missing), desc="Encoding images", disable=not accelerator.is_main_process)
+        for batch in image_batches:
+            samples = [next(loaded_images) for _ in batch]
+            images = torch.stack([img_tensor for img_tensor, _ in samples]).to(device, dtype=dtype)
+            latents, vae_batch_size = encode_images(vae, images, vae_batch_size)
+
+            for idx, (_, bucket), latent in zip(batch, samples, latents):
+                entry = {
+                    "latent": latent,
+                    "prompt_embeds": prompt_embeds.pop(idx),
+                }
+                if latent_cache:
+                    latent_cache.save(cache_keys[idx], entry)
+                store.add(idx, entry, bucket, cache_keys.get(idx))
+            progress.update(len(batch))
+        progress.close()
+
+    # Share the slices so every process ends up with the full cache
+    if num_processes > 1:
+        if latent_cache:
+            # Every slice is on disk now, so read the other processes' entries back
+            accelerator.wait_for_everyone()
+            for idx in range(len(dataset)):
+                if store.has(idx):
+                    continue
+                bucket = dataset.get_bucket(idx)
+                cache_key = latent_cache.key(dataset.samples[idx][0], dataset.get_caption(idx), bucket)
+                if not store.add_from_cache(idx, cache_key, bucket):
+                    raise RuntimeError(f"Latent cache entry for {dataset.samples[idx][0]} is missing")
+        else:
+            # Tensors must be on the CPU to be pickled across processes
+            local_entries = [
+                (idx, {name: t.cpu() for name, t in store.get(idx).items()}, store.buckets[idx])
+                for idx in local_indices
+            ]
+            for idx, entry, bucket in gather_object(local_entries):
+                if not store.has(idx):
+                    store.add(idx, entry, bucket)
 
     if accelerator.is_main_process:
-        print(f"Cached {len(cached_samples)} samples")
-
-    # Simple cached dataloader
-    def get_batch(batch_indices):
-        latents = torch.stack([cached_samples[i]["latent"] for i in batch_indices])
-        prompt_embeds = torch.stack([cached_samples[i]["prompt_embeds"] for i in batch_indices])
-        return latents, prompt_embeds
+        print(f"Cached {len(store)} samples in {cache_backend} storage "
+              f"({num_cache_hits} of this process's slice loaded from disk)")
+
+    # The frozen encoders are never used again, so give their memory to training
+    del dataset, pipe, vae, text_encoder, tokenizer
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+    if auto_batch_size and resume_state is not None and "batch_size" in resume_state:
+        # Reuse the sizes the checkpoint was trained with; probing again could pick others
+        batch_size = resume_state["batch_size"]
+        grad_accum = resume_state["grad_accum"]
+        accelerator.gradient_accumulation_steps = grad_accum
+        if accelerator.is_main_process:
+            print(f"Auto batch size: {batch_size} x {grad_accum} accumulation steps (from checkpoint)")
+    elif auto_batch_size:
+        # Probe with the largest bucket and a maximum-length prompt
+        largest = max(range(len(store)), key=lambda i: store.buckets[i][0] * store.buckets[i][1])
+        sample = store.get(largest)
+        latent = sample["latent"].to(device, dtype=dtype)
+        prompt_embeds = torch.zeros(
+            MAX_PROMPT_TOKENS, sample["prompt_embeds"].shape[-1], device=device, dtype=dtype
+        )
+
+        # Adam keeps two fp32 moments per trainable parameter
+        optimizer_bytes = 0
+        if not optimizer_offload:
+            optimizer_bytes = sum(8 * p.numel() for p in transformer.parameters() if p.requires_grad)
+
+        fit = find_max_batch_size(
+            transformer, latent, prompt_embeds,
+            max_batch_size=max_auto_batch_size,
+            memory_budget=memory_budget,
+            reserved_bytes=optimizer_bytes,
+        )
+        # Every process must use the same batch size
+        fit = int(accelerator.gather(torch.tensor([fit], device=device)).min().item())
+
+        if target_batch_size:
+            if grad_accum != 1 and accelerator.is_main_process:
+                print(f"Warning: --grad-accum {grad_accum} is replaced by the value derived from --target-batch-size")
+            # Reach the requested per-process batch with accumulation
+            grad_accum = math.ceil(target_batch_size / fit)
+            batch_size = math.ceil(target_batch_size / grad_accum)
+        else:
+            batch_size = fit
+        accelerator.gradient_accumulation_steps = grad_accum
+        if accelerator.is_main_process:
+            print(f"Auto batch size: {batch_size} x {grad_accum} accumulation steps "
+                  f"(largest that fits: {fit})")
+
+    run_config = {
+        "batch_size": batch_size,
+        "grad_accum": grad_accum,
+        "seed": seed,
+        "dataset_fingerprint": dataset_fingerprint,
+    }
+    if resume_state is not None:
+        check_resume_config(resume_state, run_config)
 
-    dataloader = DataLoader(
-        list(range(len(cached_samples))),
+    # Only batch together samples from the same bucket so latents can be stacked
+    batch_sampler = BucketBatchSampler(
+        store.buckets,
         batch_size=batch_size,
         shuffle=True,
+        seed=seed,
+        num_replicas=accelerator.num_processes,
+        rank=accelerator.process_index,
+    )
+    if len(batch_sampler) == 0:
+        raise ValueError("Batch sampler produced no batches; check dataset and batch size")
+
+    dataloader = DataLoader(
+        list(range(len(store))),
+        batch_sampler=batch_sampler,
         num_workers=0,
     )
 
-    # Optimizer
-    optimizer = torch.optim.AdamW(
-        transformer.parameters(),
+    prefetcher = BatchPrefetcher(store.get_batch, device, dtype)
+
+    # Optimizer over the LoRA parameters only
+    optimizer = build_optimizer(
+        transformer,
         lr=lr,
-        weight_decay=0.01,
+        weight_decay=weight_decay,
+        impl=optimizer_impl,
+        offload=optimizer_offload,
     )
 
     # Prepare for distributed training
-    transformer, optimizer = accelerator.prepare(transformer, optimizer)
+    if optimizer_offload:
+        # The offloaded optimizer manages its own host-side state
+        transformer = accelerator.prepare(transformer)
+    else:
+        transformer, optimizer = accelerator.prepare(transformer, optimizer)
 
     # Training loop - step-based
     global_step = 0
+    epoch = 0
+    batch_position = 0  # Micro-batches consumed in the current epoch
+
+    if resume_state is not None:
+        state = load_checkpoint(accelerator, transformer, optimizer, latest)
+        global_step = state["global_step"]
+        epoch = state["epoch"]
+        batch_position = state["batch_position"]
+
     transformer.train()
 
     progress_bar = tqdm(
         total=steps,
+        initial=global_step,
         desc="Training",
         disable=not accelerator.is_main_process,
     )
 
+    # Metrics stay on device between flushes so the loop never waits on the GPU
+    trainable_params = [p for p in transformer.parameters() if p.requires_grad]
+    metrics = TrainingMetrics(
+        device,
+        log_every=log_every,
+        jsonl_path=metrics_path or Path(output_path).with_suffix(".metrics.jsonl"),
+        samples_per_step=batch_size * grad_accum * accelerator.num_processes,
+        enabled=accelerator.is_main_process,
+    )
+    profiler = StepProfiler(
+        device,
+        warmup=profile_warmup,
+        steps=profile_steps,
+        trace_path=profile_trace,
+        enabled=profile and accelerator.is_main_process,
+    )
+
     while global_step < steps:
-        for batch_indices in dataloader:
+        batch_sampler.set_epoch(epoch)
+        # Skip batches already trained on when resuming mid-epoch
+        batches = (batch.tolist() for batch in itertools.islice(dataloader, batch_position, None))
+
+        # Cached latents and embeddings arrive on device one batch ahead of the step
+        for latents, prompt_embeds in prefetcher(batches):
             if global_step >= steps:
                 break
 
+            profiler.start_step()
             with accelerator.accumulate(transformer):
-                # Get cached latents and embeddings
-                latents, prompt_embeds = get_batch(batch_indices.tolist())
-                latents = latents.to(device, dtype=dtype)
-                prompt_embeds = prompt_embeds.to(device, dtype=dtype)
-
-                # Sample noise and timesteps for flow matching
-                noise = torch.randn_like(latents)
-                # Sample timesteps in [0, 1000] range, then convert for model
-                timesteps = torch.randint(0, 1000, (latents.shape[0],), device=device)
-
-                # Flow matching forward: x_t = (1 - t) * x_0 + t * noise
-                t_normalized = timesteps.float() / 1000.0
-                t_expanded = t_normalized.view(-1, 1, 1, 1)
-                noisy_latents = (1 - t_expanded) * latents + t_expanded * noise
-
-                # Z-Image expects [B, C, F, H, W] with frames dimension
-                noisy_latents = noisy_latents.unsqueeze(2)  # Add frames dim
-                # Convert to list of tensors (one per batch item)
-                latent_list = list(noisy_latents.unbind(dim=0))
-
-                # Timestep format for Z-Image: (1000 - t) / 1000
-                timestep_model_input = (1000 - timesteps.float()) / 1000.0
-
-                # Predict velocity using Z-Image API
-                model_out_list = transformer(
-                    latent_list,
-                    timestep_model_input,
-                    prompt_embeds,
-                )[0]
-
-                # Process output: stack, squeeze frames dim, negate
-                model_pred = torch.stack([t.float() for t in model_out_list], dim=0)
-                model_pred = model_pred.squeeze(2)  # Remove frames dim
-                model_pred = -model_pred  # Z-Image outputs need negation
-
-                # Flow matching target: velocity = noise - x_0
-                target = (noise - latents).float()
-                loss = torch.nn.functional.mse_loss(model_pred, target)
-
-                accelerator.backward(loss)
-                optimizer.step()
-                optimizer.zero_grad()
+                loss = compute_loss(transformer, latents, prompt_embeds, profiler)
+
+                with profiler.phase("backward"):
+                    accelerator.backward(loss)
+                    metrics.add_loss(loss)
+
+                norm = None
+                if accelerator.sync_gradients and metrics.enabled:
+                    norm = grad_norm(trainable_params)
+
+                with profiler.phase("optimizer"):
+                    # A prepared optimizer skips mid-accumulation steps by itself
+                    if accelerator.sync_gradients or not optimizer_offload:
+                        optimizer.step()
+                        optimizer.zero_grad()
+            profiler.end_step()
 
+            # Steps count optimizer updates, not micro-batches
+            if accelerator.sync_gradients:
                 global_step += 1
                 progress_bar.update(1)
-                progress_bar.set_postfix(loss=loss.detach().item())
-
+                record = metrics.step(global_step, optimizer.param_groups[0]["lr"], norm)
+                if record:
+                    progress_bar.set_postfix(loss=f"{record['loss']:.4f}")
+
+            batch_position += 1
+            if (
+                accelerator.sync_gradients
+                and checkpoint_every
+                and global_step % checkpoint_every == 0
+                and global_step < steps
+            ):
+                save_checkpoint(
+                    accelerator, transformer, optimizer, checkpoint_dir,
+                    global_step, epoch, batch_position, run_config, keep=keep_checkpoints,
+                )
+
+        epoch += 1
+        batch_position = 0
+
+    metrics.flush(global_step)
     progress_bar.close()
 
     # Save the trained LoRA
@@ -450,7 +1498,48 @@ def main():
     parser.add_argument("--batch-size", type=int, default=1)
     parser.add_argument("--lr", type=float, default=1e-4)
     parser.add_argument("--lora-rank", type=int, default=32)
+    parser.add_argument("--weight-decay", type=float, default=0.01)
+    parser.add_argument(
+        "--optimizer-impl",
+        choices=["default", "foreach", "fused"],
+        default="fused",
+        help="AdamW implementation",
+    )
+    parser.add_argument("--optimizer-offload", action="store_true", help="Keep optimizer state in host memory")
+    parser.add_argument("--auto-batch-size", action="store_true", help="Use the largest batch size that fits in memory")
+    parser.add_argument(
+        "--target-batch-size",
+        type=int,
+        default=None,
+        help="With --auto-batch-size, per-GPU batch to reach via gradient accumulation",
+    )
+    parser.add_argument("--max-auto-batch-size", type=int, default=64)
+    parser.add_argument("--memory-budget", type=float, default=0.9, help="Fraction of GPU memory auto batch size may use")
+    parser.add_argument("--grad-accum", type=int, default=1, help="Micro-batches per optimizer step")
+    parser.add_argument("--gradient-checkpointing", action="store_true", help="Recompute activations to save memory")
+    parser.add_argument("--log-every", type=int, default=10, help="Steps between metric flushes")
+    parser.add_argument("--metrics-path", default=None, help="JSONL metrics file (default: next to output)")
+    parser.add_argument("--checkpoint-every", type=int, default=0, help="Steps between checkpoints (0 = off)")
+    parser.add_argument("--checkpoint-dir", default=None, help="Checkpoint directory (default: <output>_checkpoints)")
+    parser.add_argument("--keep-checkpoints", type=int, default=2, help="Number of recent checkpoints to keep")
+    parser.add_argument("--resume", action="store_true", help="Resume from the latest checkpoint if one exists")
+    parser.add_argument("--profile", action="store_true", help="Report per-phase step timings (slows training)")
+    parser.add_argument("--profile-warmup", type=int, default=5, help="Micro-steps to skip before profiling")
+    parser.add_argument("--profile-steps", type=int, default=20, help="Micro-steps to profile")
+    parser.add_argument("--profile-trace", default=None, help="Export a Chrome trace of the first profiled steps")
     parser.add_argument("--cache-dir", default=None, help="HuggingFace cache directory")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for data order, noise and timesteps")
+    parser.add_argument("--latent-cache-dir", default=None, help="Directory for persistent latent/embedding cache")
+    parser.add_argument("--text-batch-size", type=int, default=16, help="Captions per text encoder batch while caching")
+    parser.add_argument("--vae-batch-size", type=int, default=8, help="Images per VAE batch while caching")
+    parser.add_argument("--decode-workers", type=int, default=4, help="Image decode workers (0 = decode inline)")
+    parser.add_argument("--decode-processes", action="store_true", help="Decode images in processes instead of threads")
+    parser.add_argument(
+        "--cache-backend",
+        choices=SampleStore.BACKENDS,
+        default="host",
+        help="Where cached samples live during training (disk requires --latent-cache-dir)",
+    )
 
     args = parser.parse_args()
 
@@ -464,6 +1553,32 @@ def main():
         lr=args.lr,
         lora_rank=args.lora_rank,
         cache_dir=args.cache_dir,
+        seed=args.seed,
+        latent_cache_dir=args.latent_cache_dir,
+        text_batch_size=args.text_batch_size,
+        vae_batch_size=args.vae_batch_size,
+        decode_workers=args.decode_workers,
+        decode_processes=args.decode_processes,
+        cache_backend=args.cache_backend,
+        grad_accum=args.grad_accum,
+        gradient_checkpointing=args.gradient_checkpointing,
+        log_every=args.log_every,
+        metrics_path=args.metrics_path,
+        checkpoint_every=args.checkpoint_every,
+        checkpoint_dir=args.checkpoint_dir,
+        keep_checkpoints=args.keep_checkpoints,
+        resume=args.resume,
+        profile=args.profile,
+        profile_warmup=args.profile_warmup,
+        profile_steps=args.profile_steps,
+        profile_trace=args.profile_trace,
+        weight_decay=args.weight_decay,
+        optimizer_impl=args.optimizer_impl,
+        optimizer_offload=args.optimizer_offload,
+        auto_batch_size=args.auto_batch_size,
+        target_batch_size=args.target_batch_size,
+        max_auto_batch_size=args.max_auto_batch_size,
+        memory_budget=args.memory_budget,
     )
 
 
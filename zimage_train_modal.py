@@ -17,6 +17,8 @@ training_output = modal.Volume.from_name("training-output", create_if_missing=Tr
 
 CACHE_DIR = "/model-cache"
 OUTPUT_DIR = "/training-output"
+LATENT_CACHE_DIR = f"{CACHE_DIR}/latent-cache"
+VOLUME_COMMIT_INTERVAL = 300  # seconds
 
 image = (
     modal.Image.debian_slim(python_version="3.12")
@@ -40,6 +42,7 @@ image = (
         "HF_HOME": CACHE_DIR,
     })
     .add_local_file("zimage_train.py", "/root/zimage_train.py")
+    .add_local_file("zimage_lora.py", "/root/zimage_lora.py")
 )
 
 
@@ -59,6 +62,12 @@ def train(
     batch_size: int = 2,  # 4 OOMs on H100
     lr: float = 1e-4,
     lora_rank: int = 32,
+    grad_accum: int = 1,
+    gradient_checkpointing: bool = False,
+    checkpoint_every: int = 250,
+    resume: bool = False,
+    auto_batch_size: bool = False,
+    target_batch_size: int | None = None,
 ):
     """Run training on Modal with uploaded dataset."""
     import subprocess
@@ -99,9 +108,31 @@ def train(
         "--lr", str(lr),
         "--lora-rank", str(lora_rank),
         "--cache-dir", CACHE_DIR,
+        "--latent-cache-dir", LATENT_CACHE_DIR,
+        "--grad-accum", str(grad_accum),
+        "--checkpoint-every", str(checkpoint_every),
     ]
-
-    result = subprocess.run(cmd, check=True)
+    if gradient_checkpointing:
+        cmd.append("--gradient-checkpointing")
+    if resume:
+        cmd.append("--resume")
+    if auto_batch_size:
+        # Without a target, train with the largest micro-batch that fits
+        cmd.append("--auto-batch-size")
+        if target_batch_size:
+            cmd += ["--target-batch-size", str(target_batch_size)]
+
+    # Commit the output volume periodically so checkpoints survive a timeout
+    process = subprocess.Popen(cmd)
+    while True:
+        try:
+            process.wait(timeout=VOLUME_COMMIT_INTERVAL)
+            break
+        except subprocess.TimeoutExpired:
+            training_output.commit()
+    if process.returncode != 0:
+        training_output.commit()
+        raise subprocess.CalledProcessError(process.returncode, cmd)
 
     # Commit output volume
     training_output.commit()
@@ -122,8 +153,25 @@ def main(*args):
     parser.add_argument("--batch-size", type=int, default=2)
     parser.add_argument("--lr", type=float, default=1e-4)
     parser.add_argument("--lora-rank", type=int, default=32)
+    parser.add_argument("--grad-accum", type=int, default=None, help="Micro-batches per optimizer step (default: 1)")
+    parser.add_argument("--gradient-checkpointing", action="store_true")
+    parser.add_argument("--checkpoint-every", type=int, default=250, help="Steps between checkpoints (0 = off)")
+    parser.add_argument("--resume", default=None, help="Output name of an interrupted run to resume")
+    parser.add_argument("--auto-batch-size", action="store_true", help="Pick the micro-batch size that fits in memory")
+    parser.add_argument(
+        "--target-batch-size",
+        type=int,
+        default=None,
+        help="With --auto-batch-size, per-GPU batch to reach via gradient accumulation",
+    )
 
     parsed = parser.parse_args(args)
+    if parsed.target_batch_size and not parsed.auto_batch_size:
+        parser.error("--target-batch-size requires --auto-batch-size")
+    if parsed.target_batch_size and parsed.grad_accum is not None:
+        parser.error("--grad-accum is derived from --target-batch-size; pass only one of them")
+    if parsed.grad_accum is None:
+        parsed.grad_accum = 1
 
     # Load dataset files
     dataset_path = Path(parsed.dataset)
@@ -141,11 +189,15 @@ def main(*args):
     print(f"Uploading {len(dataset_files)} files from {dataset_path}")
     print(f"Using 2x H100")
 
-    # Generate output name with hyperparams and timestamp
-    from datetime import datetime
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    lr_str = f"{parsed.lr:.0e}".replace("-", "")  # 1e-4 -> 1e04
-    output_name = f"{parsed.output}_{parsed.steps}steps_r{parsed.lora_rank}_lr{lr_str}_{timestamp}"
+    if parsed.resume:
+        # Reuse the interrupted run's name so its checkpoints are found
+        output_name = parsed.resume
+    else:
+        # Generate output name with hyperparams and timestamp
+        from datetime import datetime
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        lr_str = f"{parsed.lr:.0e}".replace("-", "")  # 1e-4 -> 1e04
+        output_name = f"{parsed.output}_{parsed.steps}steps_r{parsed.lora_rank}_lr{lr_str}_{timestamp}"
     print(f"Output name: {output_name}")
 
     # Run training
@@ -156,6 +208,12 @@ def main(*args):
         batch_size=parsed.batch_size,
         lr=parsed.lr,
         lora_rank=parsed.lora_rank,
+        grad_accum=parsed.grad_accum,
+        gradient_checkpointing=parsed.gradient_checkpointing,
+        checkpoint_every=parsed.checkpoint_every,
+        resume=parsed.resume is not None,
+        auto_batch_size=parsed.auto_batch_size,
+        target_batch_size=parsed.target_batch_size,
     )
 
     print(f"\nTraining complete!")
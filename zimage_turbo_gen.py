@@ -37,6 +37,8 @@ image = (
         "HF_HOME": CACHE_DIR,
     })
     .add_local_file("zimage.py", "/root/zimage.py")
+    .add_local_file("zimage_lora.py", "/root/zimage_lora.py")
+    .add_local_file("image_encoding.py", "/root/image_encoding.py")
 )
 
 with image.imports():
@@ -51,6 +53,9 @@ with image.imports():
     volumes={CACHE_DIR: model_cache, LORA_DIR: training_output},
 )
 class ImageGenerator:
+    # "merged" folds the LoRA into the weights; "runtime" applies it as side branches
+    lora_mode: str = modal.parameter(default="merged")
+
     @modal.enter()
     def enter(self):
         from huggingface_hub import snapshot_download
@@ -58,26 +63,14 @@ class ImageGenerator:
         snapshot_download(MODEL_ID, cache_dir=CACHE_DIR, token=os.environ.get("HF_TOKEN"))
         model_cache.commit()
 
-        self.model = ZImageModel(MODEL_ID, CACHE_DIR)
-        self.safety_checker = SafetyChecker()
+        self.model = ZImageModel(MODEL_ID, CACHE_DIR, lora_mode=self.lora_mode)
+        # Loaded on the first safe-mode request
+        self.safety_checker = None
 
-    @modal.method()
-    def generate(
-        self,
-        prompt: str,
-        height: int = 1024,
-        width: int = 1024,
-        num_inference_steps: int = 9,
-        seed: int | None = None,
-        lora_id: str | None = None,
-        lora_weight_name: str | None = None,
-        lora_scale: float = 1.0,
-        safe: bool = False,
-        nsfw_threshold: float = 0.9,
-    ) -> dict:
-        lora_loaded = False
+    def _resolve_lora(self, lora_id: str | None, lora_weight_name: str | None) -> str | None:
+        """Return a local path for a training-output name or HuggingFace repo ID."""
+        lora_path = None
         if lora_id:
-            lora_path = None
 
             # Check if it's a local name (no /) - look in training-output volume
             if "/" not in lora_id:
@@ -114,26 +107,48 @@ class ImageGenerator:
                     token=os.environ.get("HF_TOKEN"),
                 )
                 model_cache.commit()
+        return lora_path
+
+    def _generate(
+        self,
+        prompts: list[str],
+        seeds: list[int | None],
+        num_images_per_prompt: int,
+        height: int,
+        width: int,
+        num_inference_steps: int,
+        lora_id: str | None,
+        lora_weight_name: str | None,
+        lora_scale: float,
+        safe: bool,
+        nsfw_threshold: float,
+        output_format: str,
+        quality: int,
+    ) -> list[dict]:
+        lora_path = self._resolve_lora(lora_id, lora_weight_name)
+
+        # The LoRA stays merged between requests; a repeat request reuses it as-is
+        # (or just rescales it), and recently used LoRAs are cached on the GPU
+        self.model.set_lora(lora_path, scale=lora_scale)
+
+        # Only classify when the result will be used
+        if safe and self.safety_checker is None:
+            self.safety_checker = SafetyChecker()
+
+        results = self.model.generate_batch(
+            prompts,
+            height=height,
+            width=width,
+            num_inference_steps=num_inference_steps,
+            seeds=seeds,
+            num_images_per_prompt=num_images_per_prompt,
+            safety_checker=self.safety_checker if safe else None,
+            output_format=output_format,
+            quality=quality,
+        )
 
-            try:
-                self.model.load_lora(lora_path, scale=lora_scale)
-                lora_loaded = True
-            except Exception:
-                if lora_loaded:
-                    self.model.unload_lora()
-                raise
-
-        try:
-            result = self.model.generate(
-                prompt=prompt,
-                height=height,
-                width=width,
-                num_inference_steps=num_inference_steps,
-                seed=seed,
-                safety_checker=self.safety_checker,
-            )
-
-            # Block NSFW content in safe mode
+        # Block NSFW content in safe mode
+        for result in results:
             if safe and result["safety_scores"]:
                 nsfw_score = result["safety_scores"].get("nsfw", 0)
                 if nsfw_score > nsfw_threshold:
@@ -144,10 +159,57 @@ class ImageGenerator:
             else:
                 result["blocked"] = False
 
-            return result
-        finally:
-            if lora_loaded:
-                self.model.unload_lora()
+        return results
+
+    @modal.method()
+    def generate(
+        self,
+        prompt: str,
+        height: int = 1024,
+        width: int = 1024,
+        num_inference_steps: int = 9,
+        seed: int | None = None,
+        lora_id: str | None = None,
+        lora_weight_name: str | None = None,
+        lora_scale: float = 1.0,
+        safe: bool = False,
+        nsfw_threshold: float = 0.9,
+        output_format: str = "png",
+        quality: int = 90,
+    ) -> dict:
+        return self._generate(
+            [prompt], [seed], 1, height, width, num_inference_steps,
+            lora_id, lora_weight_name, lora_scale, safe, nsfw_threshold, output_format, quality,
+        )[0]
+
+    @modal.method()
+    def generate_batch(
+        self,
+        prompts: list[str],
+        height: int = 1024,
+        width: int = 1024,
+        num_inference_steps: int = 9,
+        seeds: list[int | None] | None = None,
+        num_images_per_prompt: int = 1,
+        lora_id: str | None = None,
+        lora_weight_name: str | None = None,
+        lora_scale: float = 1.0,
+        safe: bool = False,
+        nsfw_threshold: float = 0.9,
+        output_format: str = "png",
+        quality: int = 90,
+    ) -> list[dict]:
+        """
+        Generate num_images_per_prompt images per prompt, ordered by prompt.
+
+        Image j of prompt i uses seed seeds[i] + j, so it matches generate() with that seed.
+        """
+        if seeds is None:
+            seeds = [None] * len(prompts)
+        return self._generate(
+            prompts, seeds, num_images_per_prompt, height, width, num_inference_steps,
+            lora_id, lora_weight_name, lora_scale, safe, nsfw_threshold, output_format, quality,
+        )
 
 
 @app.local_entrypoint()
@@ -158,8 +220,13 @@ def main(
     lora: str = None,
     lora_weight_name: str = None,
     lora_scale: float = 1.0,
+    lora_mode: str = "merged",
     safe: bool = False,
+    format: str = "png",
+    quality: int = 90,
+    num_images: int = 1,
 ):
+    from image_encoding import FORMAT_EXTENSIONS, write_output
     from utils import get_output_path
 
     print(f"Generating: {prompt}")
@@ -167,30 +234,40 @@ def main(
         print(f"Using LoRA: {lora} (scale={lora_scale})")
     if safe:
         print("Safe mode: NSFW content will be blocked")
-    generator = ImageGenerator()
-    result = generator.generate.remote(
-        prompt,
-        seed=seed,
+    generator = ImageGenerator(lora_mode=lora_mode)
+    options = dict(
         lora_id=lora,
         lora_weight_name=lora_weight_name,
         lora_scale=lora_scale,
         safe=safe,
+        output_format=format,
+        quality=quality,
     )
-
-    if result["safety_scores"]:
-        nsfw_score = result["safety_scores"].get("nsfw", 0)
-        print(f"Safety: nsfw={nsfw_score:.1%}")
-
-    if result["blocked"]:
-        print("Image blocked: NSFW content detected")
-        return
+    if num_images == 1:
+        results = [generator.generate.remote(prompt, seed=seed, **options)]
+    else:
+        results = generator.generate_batch.remote([prompt], seeds=[seed], num_images_per_prompt=num_images, **options)
 
     # Include lora name and scale in output filename
     if lora:
         prefix = f"{lora}_s{lora_scale}"
     else:
         prefix = "zimage_nolora"
+    ext = FORMAT_EXTENSIONS[format]
+
+    for j, result in enumerate(results):
+        if result["safety_scores"]:
+            nsfw_score = result["safety_scores"].get("nsfw", 0)
+            print(f"Safety: nsfw={nsfw_score:.1%}")
+
+        if result["blocked"]:
+            print("Image blocked: NSFW content detected")
+            continue
 
-    output_path = get_output_path(prompt, output, prefix=prefix)
-    output_path.write_bytes(result["image_bytes"])
-    print(f"Saved to {output_path}")
+        if num_images == 1:
+            output_path = get_output_path(prompt, output, prefix=prefix, ext=ext)
+        else:
+            numbered = f"{os.path.splitext(output)[0]}_{j}.{ext}" if output else None
+            output_path = get_output_path(prompt, numbered, prefix=f"{prefix}_{j}", ext=ext)
+        write_output(result["image_bytes"], output_path)
+        print(f"Saved to {output_path}")